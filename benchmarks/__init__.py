@@ -0,0 +1,5 @@
+'''
+Benchmarks of butler on synthetic products scaled from 10 to 10k projects.
+
+python -m benchmarks.run --help
+'''
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''
+Time the startup of butler and cikit, the cost every call of the CLIs pays before doing anything.
+
+python benchmarks/bench_import.py [--repeat 10] [--max-seconds 0.5]
+
+Each module is imported by a new python process. The command fails when an import takes longer than
+max-seconds, or when it loads one of the heavy modules which must only be imported by the commands
+using them.
+'''
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ["butler", "cikit.cmds"]
+
+DEFERRED_MODULES = ["requests", "urllib2", "xml.etree.ElementTree", "multiprocessing.pool",
+                    "redis", "cikit.cibuild"]
+
+_PROBE = '''
+import sys, time, json
+start = time.time()
+import %s
+elapsed = time.time() - start
+print json.dumps({"seconds": elapsed, "loaded": [m for m in %r if m in sys.modules]})
+'''
+
+def time_import(module):
+    '''
+    return - (float, list of string), seconds to import module in a new process, the deferred
+             modules it loaded
+    '''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get("PYTHONPATH", "")]))
+    output = subprocess.check_output([sys.executable, "-c", _PROBE % (module, DEFERRED_MODULES)], cwd=ROOT, env=env)
+    result = json.loads(output.splitlines()[-1])
+    return (result["seconds"], result["loaded"])
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='bench_import')
+    parser.add_argument('--repeat', action='store', dest='repeat', type=int, default=10)
+    parser.add_argument('--max-seconds', action='store', dest='max_seconds', type=float, default=0.5)
+    args = parser.parse_args(argv[1:])
+
+    failures = []
+    for module in MODULES:
+        best = None
+        for i in range(args.repeat):
+            (seconds, loaded) = time_import(module)
+            best = seconds if best is None else min(best, seconds)
+        print "import %-12s %8.4fs" % (module, best)
+        if(best > args.max_seconds):
+            failures.append("import %s takes %.4fs, more than %.4fs" % (module, best, args.max_seconds))
+        if(loaded):
+            failures.append("import %s loads %s" % (module, ", ".join(loaded)))
+
+    for f in failures:
+        print >> sys.stderr, "Regression: " + f
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+'''
+Synthetic inputs of butler for a product of n projects: the manifest printed by "repo manifest -r",
+repo_graph.json, package.json and build-info.properties.
+'''
+import json
+import random
+
+COMPONENTS_PER_REPO = 5
+
+def repo_name(i):
+    return "bench-repo%d" % i
+
+def gen_manifest_xml(n, seed=0):
+    '''
+    return - string, manifest xml with n projects pinned to commits
+    '''
+    rnd = random.Random(seed)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<manifest>',
+             '  <remote fetch=".." name="origin"/>',
+             '  <default remote="origin" revision="master" sync-j="4"/>']
+    for i in range(n):
+        lines.append('  <project name="%s" path="src/%s" revision="%040x" upstream="master"/>' % (repo_name(i), repo_name(i), rnd.getrandbits(160)))
+    lines.append('</manifest>')
+    return "\n".join(lines)
+
+def gen_repo_graph(n, fanout=3, seed=0):
+    '''
+    return - list of dict, repo_graph.json of n repos, each repo impacts up to fanout of the following ones
+    '''
+    rnd = random.Random(seed)
+    graph = []
+    for i in range(n):
+        impact = sorted(set(rnd.randint(i + 1, min(n - 1, i + 50)) for f in range(fanout))) if i < n - 1 else []
+        graph.append({"name": repo_name(i), "impact": [repo_name(j) for j in impact]})
+    return graph
+
+def gen_packageinfo(n, version="1.0.0", buildnumber=1, components=COMPONENTS_PER_REPO):
+    '''
+    return - dict, package.json of a product of n repos with components each
+    '''
+    buildversion = "%s_b%d" % (version, buildnumber)
+    repos = []
+    for i in range(n):
+        repos.append({"repoName": repo_name(i),
+                      "commit": "%040x" % i,
+                      "author": "bench@example.com",
+                      "version": buildversion,
+                      "components": [{"name": "%s-c%d" % (repo_name(i), c),
+                                      "storage": {"groupId": "com.bench.product",
+                                                  "artifactId": "%s-c%d" % (repo_name(i), c),
+                                                  "packaging": "jar",
+                                                  "version": buildversion,
+                                                  "classifier": "N/A"},
+                                      "packageLayout": "lib"} for c in range(components)]})
+    return {"product": "bench",
+            "version": version,
+            "buildNumber": str(buildnumber),
+            "storage": {"groupId": "com.bench.product",
+                        "artifactId": "bench",
+                        "packaging": "json",
+                        "version": buildversion,
+                        "classifier": "full"},
+            "repos": repos}
+
+def gen_buildinfo_properties(n, version="1.0.0", buildnumber=2, changed_ratio=0.1, seed=0):
+    '''
+    return - string, build-info.properties of the build after gen_packageinfo, changed_ratio of the repos need to build
+    '''
+    rnd = random.Random(seed)
+    buildversion = "%s_b%d" % (version, buildnumber)
+    props = {"product_name": "bench",
+             "product_version": version,
+             "product_build_number": str(buildnumber),
+             "product_build_version": buildversion,
+             "product_manifest_branch": "master"}
+    for i in range(n):
+        prefix = repo_name(i).replace("-", "_")
+        props[prefix + "_build_needed"] = str(rnd.random() < changed_ratio)
+        props[prefix + "_build_commit"] = "%040x" % (i + n)
+        props[prefix + "_build_commit_author"] = "bench@example.com"
+        props[prefix + "_build_version"] = buildversion
+    return "".join("%s=%s\n" % (k, v) for (k, v) in sorted(props.items()))
+
+def save_json(jobject, outfile):
+    with open(outfile, "w") as f:
+        json.dump(jobject, f)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+'''
+Time the pure computations of butler on synthetic products and compare them with a baseline.
+
+python -m benchmarks.run --output results.json
+python -m benchmarks.run --baseline results.json --threshold 1.5
+
+The results are json: {"results": [{"case": ..., "scale": ..., "seconds": ...}, ...]}. With a baseline
+the command fails when a case is slower than threshold times its baseline. It also fails when a case
+takes longer than its budget in BUDGETS, whatever the baseline.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import butler
+from benchmarks import generators
+
+DEFAULT_SCALES = "10,100,1000,10000"
+
+def _setup_calculate_repos_buildneeded(scale, workdir):
+    manifestdir = os.path.join(workdir, ".repo", "manifests")
+    os.makedirs(manifestdir)
+    generators.save_json(generators.gen_repo_graph(scale), os.path.join(manifestdir, "repo_graph.json"))
+    changed = [generators.repo_name(i) for i in range(0, scale, 100)]
+
+    def _run():
+        # Time the compilation of the graph too, not only the lookup in the compiled graphs.
+        #
+        butler.RepoGraph._compiled.clear()
+        butler._calculate_repos_buildneeded(workdir, changed)
+    return _run
+
+def _setup_parse_manifest_projects(scale, workdir):
+    xml = generators.gen_manifest_xml(scale)
+    return lambda: butler._parse_manifest_projects(xml)
+
+def _setup_gen_new_packageinfo(scale, workdir):
+    # The whole computation from the json package infos: the records, and the full, increment and
+    # patch package infos.
+    #
+    pre_released = generators.gen_packageinfo(scale, buildnumber=1)
+    pre_build = generators.gen_packageinfo(scale, buildnumber=1)
+    propfile = os.path.join(workdir, "build-info.properties")
+    with open(propfile, "w") as f:
+        f.write(generators.gen_buildinfo_properties(scale, buildnumber=2))
+    props = butler._load_buildproperties(propfile)
+    return lambda: butler._gen_new_packageinfo(pre_released, pre_build, props)
+
+def _setup_compare_packageinfo(scale, workdir):
+    packageinfo1 = generators.gen_packageinfo(scale, buildnumber=2)
+    packageinfo2 = generators.gen_packageinfo(scale, buildnumber=1)
+    return lambda: butler._compare_packageinfo(packageinfo1, packageinfo2)
+
+def _setup_gen_buildinfo_props(scale, workdir):
+    blist = []
+    for i in range(scale):
+        repo = butler.Repo(generators.repo_name(i), "%040x" % i, "%07x" % i, "master", "bench@example.com", "1.0.0_b1")
+        repo.buildneeded = (i % 10 == 0)
+        blist.append(repo)
+    manifestinfo = ("ssh://example.com/manifest", "master", "master", "%040x" % scale)
+
+    def _run():
+        props = butler._gen_buildinfo_props("bench", "1.0.0", 2, 2, manifestinfo, blist)
+        butler._gen_prop_file(props, workdir)
+    return _run
+
+def _setup_gen_composite_download_spec(scale, workdir):
+    packageinfo = generators.gen_packageinfo(scale)
+    return lambda: butler._gen_composite_download_spec_ext(packageinfo, "bench-repo", workdir + os.sep)
+
+CASES = [("calculate_repos_buildneeded", _setup_calculate_repos_buildneeded),
+         ("parse_manifest_projects", _setup_parse_manifest_projects),
+         ("gen_new_packageinfo", _setup_gen_new_packageinfo),
+         ("compare_packageinfo", _setup_compare_packageinfo),
+         ("gen_buildinfo_props", _setup_gen_buildinfo_props),
+         ("gen_composite_download_spec", _setup_gen_composite_download_spec)]
+
+# Seconds a case may take at a scale. 10k repos of 5 components each are 50k components, for which
+# the package infos take about 0.3s.
+#
+BUDGETS = {("gen_new_packageinfo", 10000): 0.5}
+
+def run_cases(scales, repeat, cases=None):
+    '''
+    return - list of dict, {"case":..., "scale":..., "seconds":...}, the best time of repeat runs
+    '''
+    results = []
+    for (name, setup) in CASES:
+        if(cases and name not in cases):
+            continue
+        for scale in scales:
+            workdir = tempfile.mkdtemp(prefix="butler-bench-")
+            try:
+                func = setup(scale, workdir)
+                best = None
+                for i in range(repeat):
+                    start = time.time()
+                    func()
+                    elapsed = time.time() - start
+                    best = elapsed if best is None else min(best, elapsed)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            results.append({"case": name, "scale": scale, "seconds": best})
+            print >> sys.stderr, "%-30s %6d %10.4fs" % (name, scale, best)
+    return results
+
+def find_regressions(results, baseline, threshold, min_seconds):
+    '''
+    return - list of string, the cases slower than threshold times their baseline, the cases faster
+             than min_seconds are too noisy to be compared
+    '''
+    baseline_seconds = dict(((r["case"], r["scale"]), r["seconds"]) for r in baseline["results"])
+    regressions = []
+    for r in results:
+        base = baseline_seconds.get((r["case"], r["scale"]))
+        if(base is None or r["seconds"] < min_seconds):
+            continue
+        if(r["seconds"] > base * threshold):
+            regressions.append("%s at scale %d: %.4fs, baseline %.4fs" % (r["case"], r["scale"], r["seconds"], base))
+    return regressions
+
+def find_budget_overruns(results, budgets=BUDGETS):
+    '''
+    return - list of string, the cases slower than their budget
+    '''
+    overruns = []
+    for r in results:
+        budget = budgets.get((r["case"], r["scale"]))
+        if(budget is not None and r["seconds"] > budget):
+            overruns.append("%s at scale %d: %.4fs, budget %.4fs" % (r["case"], r["scale"], r["seconds"], budget))
+    return overruns
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='benchmarks.run', description="Benchmarks of butler")
+    parser.add_argument('--scales', action='store',
+                        dest='scales',
+                        default=DEFAULT_SCALES,
+                        help='Store the comma separated numbers of projects')
+    parser.add_argument('--cases', action='store',
+                        dest='cases',
+                        default=None,
+                        help='Store the comma separated cases to run, all by default')
+    parser.add_argument('--repeat', action='store',
+                        dest='repeat',
+                        type=int,
+                        default=3,
+                        help='Store how many times each case runs, the best time is kept')
+    parser.add_argument('--output', action='store',
+                        dest='output',
+                        default=None,
+                        help='Store the result file, stdout by default')
+    parser.add_argument('--baseline', action='store',
+                        dest='baseline',
+                        default=None,
+                        help='Store the result file of a previous run to compare with')
+    parser.add_argument('--threshold', action='store',
+                        dest='threshold',
+                        type=float,
+                        default=1.5,
+                        help='Store the ratio to the baseline above which a case is a regression')
+    parser.add_argument('--min-seconds', action='store',
+                        dest='min_seconds',
+                        type=float,
+                        default=0.005,
+                        help='Store the time below which a case is never a regression')
+    args = parser.parse_args(argv[1:])
+
+    scales = [int(s) for s in args.scales.split(",")]
+    cases = args.cases.split(",") if args.cases else None
+    report = {"python": platform.python_version(),
+              "platform": platform.platform(),
+              "results": run_cases(scales, args.repeat, cases)}
+
+    if(args.output):
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print json.dumps(report, indent=2)
+
+    regressions = find_budget_overruns(report["results"])
+    if(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions.extend(find_regressions(report["results"], baseline, args.threshold, args.min_seconds))
+    for r in regressions:
+        print >> sys.stderr, "Regression: " + r
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,20 +1,89 @@
 #!/usr/bin/env python
 
 import os
-import urllib2
 import re
+import errno
 import subprocess
-import xml.etree.ElementTree as ET
 import argparse
 import sys
-import requests
 import json
-import copy
 import hashlib
 import shutil
-from requests.auth import HTTPBasicAuth
-from properties.p import Property
+import threading
+import time
+import collections
+import atexit
+import urllib
+import glob
+import socket
+import signal
+import struct
+import traceback
+import uuid
+import StringIO
+import SocketServer
 import platform
+from abc import ABCMeta, abstractmethod
+from cikit.ciutils.cmdutils import CMDPool
+from cikit.ciutils.gitutils import GitTagIndex, GitTagService, ABBREV_LENGTH, abbrevLength
+from cikit.ciutils import tracing
+from cikit.ciutils.buildinfo import BuildInfo, RepoBuildInfo
+
+# Jenkins change lookups of unsuccessful builds are fetched concurrently, at most
+# _JENKINS_FETCH_WORKERS at a time, and each request gives up after _JENKINS_TIMEOUT seconds.
+#
+_JENKINS_FETCH_WORKERS = 8
+_JENKINS_TIMEOUT = 30
+
+# Jenkins json api tree to get the changes of the latest builds with one request. Freestyle builds
+# export their changes as "changeSet" and pipeline builds as "changeSets", the repo plugin exports
+# the project name of every change as "serverPath".
+#
+_JENKINS_CHANGES_WINDOW = 100
+_JENKINS_CHANGES_TREE = "lastSuccessfulBuild[number]," \
+                        "builds[number,changeSet[items[serverPath,path]],changeSets[items[serverPath,path]]]{0,%d}" % _JENKINS_CHANGES_WINDOW
+
+# Upper bound of the disk space used to cache the changes of finished builds.
+#
+_CHANGES_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# Build metadata shared through redis never changes once created (it is keyed by commit or build),
+# the expiration only lets redis reclaim the memory of what is not used any more.
+#
+_META_CACHE_TTL = 30 * 24 * 3600
+_REDIS_TIMEOUT = 2
+
+# Metadata cache namespace of the abbreviated commit and author of commits. The cache of the
+# fixed-length abbreviations of older butler versions is not used.
+#
+_COMMIT_INFO_CACHE = "commitinfo2"
+
+# Products of a pre_build_batch running at the same time.
+#
+_PRE_BUILD_BATCH_WORKERS = 4
+
+# Times the build numbers are allocated again when the build tags were published by another build first.
+#
+_TAG_PUSH_RETRIES = 5
+
+# Native artifactory client: parallel transfers, timeout of each request and size of the blocks
+# read from disk.
+#
+_ARTIFACTORY_WORKERS = 4
+_ARTIFACTORY_TIMEOUT = 300
+_ARTIFACTORY_BLOCK_SIZE = 1024 * 1024
+_ARTIFACTORY_RETRIES = 3
+
+# Checksums are computed from blocks big enough for hashlib to release the GIL most of the time, so
+# files hashed by different threads are hashed in parallel.
+#
+_CHECKSUM_BLOCK_SIZE = 4 * 1024 * 1024
+_CHECKSUM_WORKERS = 4
+_CHECKSUM_ALGORITHMS = ("md5", "sha1", "sha256")
+
+# Default of the arguments and the attributes for which None is a value.
+#
+_MISSING = object()
 
 def _dash_to_underscore(value):
     return value.replace("-", "_")
@@ -28,6 +97,9 @@ class ButlerConfig(object):
     _all_jenkins = None
     _all_arts = None
     _all_redis = None
+    _settings = {}
+    _loaded_mtime = None
+    _reload_lock = threading.Lock()
     @staticmethod
     def load():
         if(not os.path.exists(os.path.join(ButlerConfig._home,".butler"))):
@@ -37,13 +109,14 @@ class ButlerConfig(object):
             config_template = {}
             jenkins = []
             jenkins.append({"url":"http(s)://xxxx:8080/jenkins/", "user":"<user>", "password":"<password>",
-                            "serverId":"<jenkins-id>", "isDefault":"true"})
+                            "serverId":"<jenkins-id>", "changesApi":"html", "isDefault":"true"})
             config_template["jenkins"] = jenkins
             
             arts = []
             arts.append({"url": "http(s)://xxxx:8080/artifactory/",
                          "apiKey": "<key>",
                          "serverId": "mikepro-artifactory",
+                         "client": "jfrog",
                          "isDefault": "true"})
             config_template["artifactory"] = arts
             
@@ -51,36 +124,50 @@ class ButlerConfig(object):
             redis.append({"host": "mikepro.local",
                           "port": "6379",
                           "serverId": "mikepro-redis",
+                          "metaCache": "false",
                           "downloadRepo":"<downloadrepo>",
                           "uploadRepo":"<uploadrepo",
                           "isDefault": "true"})
             config_template["redis"] = redis
+            config_template["buildNumberAllocator"] = "tags"
             
             _serialize_jsonobject(config_template, os.path.join(ButlerConfig._home,".butler", "butler.conf.template"))
             raise Exception("You need to modify template configure %s and remove .template from file name before running butler" % (os.path.join(ButlerConfig._home,".butler", "butler.conf.template"),))
 
+        loaded_mtime = os.path.getmtime(os.path.join(ButlerConfig._home,".butler", "butler.conf"))
         config_obj = _deserialize_jsonobject(os.path.join(ButlerConfig._home,".butler", "butler.conf"))
-        ButlerConfig._all_jenkins = config_obj["jenkins"]
-        ButlerConfig._all_arts = config_obj["artifactory"]
-        ButlerConfig._all_redis = config_obj["redis"]
 
+        # The servers are indexed from scratch, so the ones removed from butler.conf are gone after a reload.
+        #
+        jenkins_servers = {}
         for j in config_obj["jenkins"]:
             server_id = j["serverId"]
-            ButlerConfig._jenkins[server_id] = j
+            jenkins_servers[server_id] = j
             if(j["isDefault"] == "true"):
-                ButlerConfig._jenkins["default"] = j
+                jenkins_servers["default"] = j
                 
+        art_servers = {}
         for art in config_obj["artifactory"]:
             server_id = art["serverId"]
-            ButlerConfig._arts[server_id] = art
+            art_servers[server_id] = art
             if(art["isDefault"] == "true"):
-                ButlerConfig._arts["default"] = art
+                art_servers["default"] = art
                 
+        redis_servers = {}
         for r in config_obj["redis"]:
             server_id = r["serverId"]
-            ButlerConfig._redis[server_id] = r
+            redis_servers[server_id] = r
             if(r["isDefault"] == "true"):
-                ButlerConfig._redis["default"] = r
+                redis_servers["default"] = r
+
+        ButlerConfig._jenkins = jenkins_servers
+        ButlerConfig._arts = art_servers
+        ButlerConfig._redis = redis_servers
+        ButlerConfig._all_jenkins = config_obj["jenkins"]
+        ButlerConfig._all_arts = config_obj["artifactory"]
+        ButlerConfig._all_redis = config_obj["redis"]
+        ButlerConfig._settings = dict((k, v) for (k, v) in config_obj.items() if k not in ("jenkins", "artifactory", "redis"))
+        ButlerConfig._loaded_mtime = loaded_mtime
                 
         if(not os.path.exists(ButlerConfig._butler_data)):
             os.mkdir(ButlerConfig._butler_data)
@@ -88,7 +175,30 @@ class ButlerConfig(object):
     @staticmethod
     def home():
         return ButlerConfig._home
+
+    @staticmethod
+    def setting(name, default=None):
+        return ButlerConfig._settings.get(name, default)
     
+    @staticmethod
+    def reload_if_changed():
+        '''
+        Load butler.conf again if it was modified since it was loaded, butler server calls it before every command.
+        The clients built from the previous configuration are dropped and created again when they are used.
+        '''
+        with ButlerConfig._reload_lock:
+            try:
+                mtime = os.path.getmtime(os.path.join(ButlerConfig._home,".butler", "butler.conf"))
+            except OSError:
+                mtime = None
+            if(mtime != ButlerConfig._loaded_mtime):
+                ButlerConfig.load()
+                _reset_configured_clients()
+
+    @staticmethod
+    def default_socket():
+        return os.path.join(ButlerConfig._home, ".butler", "butler.sock")
+
     @staticmethod
     def datadir():
         return ButlerConfig._butler_data
@@ -103,6 +213,10 @@ class ButlerConfig(object):
     @staticmethod
     def default_jenkins():
         return ButlerConfig.jenkins("default")
+
+    @staticmethod
+    def jenkins_setting(server_id, name, default=None):
+        return ButlerConfig._jenkins[server_id].get(name, default)
     
     @staticmethod
     def all_jenkins():
@@ -118,6 +232,10 @@ class ButlerConfig(object):
     @staticmethod
     def default_artifactory():
         return ButlerConfig.artifactory("default")
+
+    @staticmethod
+    def artifactory_setting(server_id, name, default=None):
+        return ButlerConfig._arts[server_id].get(name, default)
     
     @staticmethod
     def all_artifactories():
@@ -133,38 +251,159 @@ class ButlerConfig(object):
     @staticmethod
     def default_redis():
         return ButlerConfig.redis("default")
+
+    @staticmethod
+    def redis_setting(server_id, name, default=None):
+        return ButlerConfig._redis.get(server_id, {}).get(name, default)
     
     @staticmethod
     def all_redis():
         return ButlerConfig._all_redis
         
 
-class PathStackMgr(object):
-    def __init__(self):
-        self.pathStack = list()
-        
-    def pushd(self, path):
-        try:
-            currentPath = os.getcwd()
-            self.pathStack.append(currentPath)
-            os.chdir(path)
-        except Exception as err:
-            print err
-            raise
-        
-    def popd(self):
-        try:
-            if(len(self.pathStack) > 0):
-                os.chdir(self.pathStack.pop())
-        except Exception as err:
-            print err
-            raise
-            
+class PooledRestClient(object):
+    '''
+    HTTP client keeping its connections alive in a per-host pool, so that all the REST calls
+    of one butler run share the same TCP/TLS sessions. Responses carrying an ETag or a
+    Last-Modified header are kept and revalidated with a conditional GET the next time the
+    same url is requested.
+    '''
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    # Upper bound of responses kept for revalidation.
+    #
+    _MAX_VALIDATED = 256
+
+    # Latencies of the latest requests kept for stats(), the totals cover all the requests.
+    #
+    _MAX_LATENCIES = 1024
+
+    def __init__(self, pool_hosts=4, pool_maxsize=_JENKINS_FETCH_WORKERS, timeout=_JENKINS_TIMEOUT):
+        '''
+        pool_hosts - number of hosts whose connection pools are kept
+        pool_maxsize - maximum connections opened to one host at the same time
+        timeout - default timeout in seconds of every request
+        '''
+        import requests
+        from requests.adapters import HTTPAdapter
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._session.verify = False
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_maxsize, pool_block=True)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.hooks["response"].append(PooledRestClient._trace_response)
+        self._auths = {}
+        self._validated = collections.OrderedDict()
+        self._latencies = collections.deque(maxlen=PooledRestClient._MAX_LATENCIES)
+        self._requests = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._revalidated = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def shared():
+        with PooledRestClient._shared_lock:
+            if(PooledRestClient._shared is None):
+                PooledRestClient._shared = PooledRestClient()
+        return PooledRestClient._shared
+
+    @property
+    def session(self):
+        return self._session
+
+    @staticmethod
+    def _trace_response(response, *args, **kwargs):
+        # The latency of a streamed response is the time to its headers, its body is traced by
+        # the caller reading it.
+        #
+        if(tracing.Tracer.current()):
+            latency = response.elapsed.total_seconds()
+            length = response.headers.get("Content-Length")
+            tracing.addSpan("HTTP %s" % response.request.method, "http", time.time() - latency, latency,
+                            url=response.url, status=response.status_code, bytes=int(length) if length else None)
+
+    def _auth(self, username, password):
+        if(not (username and password)):
+            return None
+        from requests.auth import HTTPBasicAuth
+        with self._lock:
+            if((username, password) not in self._auths):
+                self._auths[(username, password)] = HTTPBasicAuth(username, password)
+            return self._auths[(username, password)]
+
+    def getStringContent(self, url, username=None, password=None, timeout=None):
+        headers = {}
+        with self._lock:
+            # The least recently used responses are evicted first.
+            #
+            validated = self._validated.pop(url, None)
+            if(validated):
+                self._validated[url] = validated
+        if(validated):
+            (etag, lastModified, content) = validated
+            if(etag):
+                headers["If-None-Match"] = etag
+            if(lastModified):
+                headers["If-Modified-Since"] = lastModified
+
+        start = time.time()
+        myResponse = self._session.get(url, auth=self._auth(username, password), headers=headers,
+                                       timeout=timeout if timeout else self._timeout)
+        elapsed = time.time() - start
+
+        if(myResponse.status_code == 304 and validated):
+            with self._lock:
+                self._add_latency(url, elapsed)
+                self._revalidated += 1
+            return validated[2]
+
+        if(not myResponse.ok):
+            # If response code is not ok (200), print the resulting http error code with description
+            myResponse.raise_for_status()
+
+        content = myResponse.content
+        etag = myResponse.headers.get("ETag")
+        lastModified = myResponse.headers.get("Last-Modified")
+        with self._lock:
+            self._add_latency(url, elapsed)
+            if(etag or lastModified):
+                self._validated.pop(url, None)
+                if(len(self._validated) >= PooledRestClient._MAX_VALIDATED):
+                    self._validated.popitem(last=False)
+                self._validated[url] = (etag, lastModified, content)
+
+        return content
+
+    def getJSONContent(self, url, username=None, password=None, timeout=None):
+        return json.loads(self.getStringContent(url, username, password, timeout))
+
+    def _add_latency(self, url, elapsed):
+        # Called with self._lock held.
+        #
+        self._latencies.append((url, elapsed))
+        self._requests += 1
+        self._total += elapsed
+        self._max = max(self._max, elapsed)
+
+    def stats(self):
+        '''
+        return - dict, number of requests, how many of them were answered by "304 Not Modified",
+                 total/max latency in seconds and the latency of the latest requests as (url, seconds)
+        '''
+        with self._lock:
+            return {"requests": self._requests,
+                    "revalidated": self._revalidated,
+                    "total": self._total,
+                    "max": self._max,
+                    "latencies": list(self._latencies)}
 
 class SimpleRestClient:
     @staticmethod
-    def getJSONContent(url, username=None, password=None):
-        content = SimpleRestClient.getStringContent(url, username, password)
+    def getJSONContent(url, username=None, password=None, timeout=None):
+        content = SimpleRestClient.getStringContent(url, username, password, timeout)
         
         # Loading the response data into a dict variable
         # json.loads takes in only binary or string variables so using content to fetch binary content
@@ -173,15 +412,356 @@ class SimpleRestClient:
         return jData
     
     @staticmethod
-    def getStringContent(url, username=None, password=None):
-        jauth = HTTPBasicAuth(username,password) if (username and password) else None
-        myResponse = requests.get(url, verify=False, auth=jauth)
-        
-        if(not myResponse.ok):
-            # If response code is not ok (200), print the resulting http error code with description
-            myResponse.raise_for_status()
+    def getStringContent(url, username=None, password=None, timeout=None):
+        # All the calls go through the pooled client shared by the whole process.
+        #
+        return PooledRestClient.shared().getStringContent(url, username, password, timeout)
 
-        return myResponse.content
+class BuildChangesCache(object):
+    '''
+    Disk cache of the changed repos of finished jenkins builds, whose changes never change again.
+    Each build is stored as a small json file under <datadir>/changes keyed by job url and build
+    number, the least recently used files are removed once the cache grows beyond max_bytes.
+    '''
+    def __init__(self, cachedir=None, max_bytes=_CHANGES_CACHE_MAX_BYTES):
+        self._cachedir = cachedir if cachedir else os.path.join(ButlerConfig.datadir(), "changes")
+        self._max_bytes = max_bytes
+
+    def _entry(self, joburl, number):
+        jobkey = hashlib.sha1(joburl.rstrip("/")).hexdigest()
+        return os.path.join(self._cachedir, "%s_%d.json" % (jobkey, int(number)))
+
+    def get(self, joburl, number):
+        '''
+        return - list of string, None if the build was never cached
+        '''
+        entry = self._entry(joburl, number)
+        try:
+            with open(entry, "r") as f:
+                changedRepos = json.load(f)
+            # Touch the entry so that it is the most recently used one.
+            #
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return changedRepos
+
+    def put(self, joburl, number, changedRepos):
+        entry = self._entry(joburl, number)
+        tmpEntry = "%s.%d.%d.tmp" % (entry, os.getpid(), threading.current_thread().ident)
+        try:
+            if(not os.path.exists(self._cachedir)):
+                os.makedirs(self._cachedir)
+            with open(tmpEntry, "w") as f:
+                json.dump(changedRepos, f)
+            # Entries are written to a temporary file and renamed, so that concurrent butler
+            # runs never read a partial entry.
+            #
+            if(os.path.exists(entry)):
+                os.remove(entry)
+            os.rename(tmpEntry, entry)
+        except (IOError, OSError) as err:
+            # The cache is only an optimization, failing to write it shouldn't fail the build.
+            #
+            print err
+            if(os.path.exists(tmpEntry)):
+                os.remove(tmpEntry)
+
+    def evict(self):
+        try:
+            entries = []
+            totalBytes = 0
+            for name in os.listdir(self._cachedir):
+                if(name.endswith(".json")):
+                    st = os.stat(os.path.join(self._cachedir, name))
+                    entries.append((st.st_mtime, st.st_size, name))
+                    totalBytes += st.st_size
+            entries.sort()
+            for (mtime, size, name) in entries:
+                if(totalBytes <= self._max_bytes):
+                    break
+                os.remove(os.path.join(self._cachedir, name))
+                totalBytes -= size
+        except OSError as err:
+            print err
+
+class LocalRedis(object):
+    '''
+    In-process stand-in of the few redis commands used by butler. It is used when no redis server
+    is configured for the metadata cache or the configured server can't be reached. Unlike redis,
+    it is bounded: the least recently used keys are evicted past _MAX_ENTRIES, expired keys are
+    purged every _PURGE_INTERVAL seconds and no key lives longer than _MAX_TTL in the process.
+    '''
+    # Upper bound of keys kept, about the commit infos of a few large products.
+    #
+    _MAX_ENTRIES = 100000
+
+    # A long-running serve has no use of the 30-day expiration of the shared cache, the metadata
+    # is fetched again after a day.
+    #
+    _MAX_TTL = 24 * 3600
+    _PURGE_INTERVAL = 300
+
+    def __init__(self):
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._purgeAt = time.time() + LocalRedis._PURGE_INTERVAL
+
+    def _get(self, key):
+        entry = self._data.pop(key, None)
+        if(entry is not None):
+            (value, expireAt) = entry
+            if(expireAt > time.time()):
+                self._data[key] = entry
+                return value
+        return None
+
+    def _put(self, key, value, ex=None):
+        now = time.time()
+        if(now >= self._purgeAt):
+            self._purge(now)
+        self._data.pop(key, None)
+        if(len(self._data) >= LocalRedis._MAX_ENTRIES):
+            self._data.popitem(last=False)
+        self._data[key] = (str(value), now + min(ex or LocalRedis._MAX_TTL, LocalRedis._MAX_TTL))
+
+    def _purge(self, now):
+        for key in [key for (key, (value, expireAt)) in self._data.iteritems() if expireAt <= now]:
+            del self._data[key]
+        self._purgeAt = now + LocalRedis._PURGE_INTERVAL
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if(nx and self._get(key) is not None):
+                return None
+            self._put(key, value, ex)
+            return True
+
+    def setnx(self, key, value):
+        return self.set(key, value, nx=True) is True
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            value = int(self._get(key) or 0) + amount
+            self._put(key, value)
+            return value
+
+    def delete(self, *keys):
+        with self._lock:
+            deleted = 0
+            for key in keys:
+                if(self._get(key) is not None):
+                    del self._data[key]
+                    deleted += 1
+            return deleted
+
+    def ping(self):
+        return True
+
+_default_redis_client = None
+_default_redis_lock = threading.Lock()
+
+def _connect_default_redis():
+    '''
+    Connect to the default redis server once per process.
+    return - redis.StrictRedis, None if no default redis server is configured or it can't be reached
+    '''
+    global _default_redis_client
+    with _default_redis_lock:
+        if(_default_redis_client is None):
+            try:
+                (host, port, server_id) = ButlerConfig.default_redis()
+            except KeyError:
+                return None
+
+            try:
+                import redis
+                client = redis.StrictRedis(host=host, port=int(port),
+                                           socket_timeout=_REDIS_TIMEOUT,
+                                           socket_connect_timeout=_REDIS_TIMEOUT)
+                client.ping()
+                _default_redis_client = client
+            except Exception as err:
+                print "Redis %s:%s can't be used!" % (host, port)
+                print err
+                return None
+
+        return _default_redis_client
+
+def _reset_configured_clients():
+    '''
+    Drop the shared clients holding servers, credentials or settings of butler.conf. The commands still running
+    keep the clients they hold.
+    '''
+    global _default_redis_client
+    with _default_redis_lock:
+        _default_redis_client = None
+    with MetaCache._shared_lock:
+        MetaCache._shared = None
+    with PooledRestClient._shared_lock:
+        PooledRestClient._shared = None
+    with ArtifactoryClient._clients_lock:
+        ArtifactoryClient._clients = {}
+
+class MetaCache(object):
+    '''
+    Build metadata cache shared by all the butler runs of the build farm through the default redis
+    server, enabled by "metaCache": "true" in its configuration. Values are stored as json under
+    "butler:<namespace>:<key>". Without a reachable redis server, an in-process LocalRedis is used
+    so that the cache still works within one butler process.
+    '''
+    _shared = None
+    _shared_lock = threading.Lock()
+    _PREFIX = "butler"
+
+    def __init__(self, client):
+        self._client = client
+
+    @staticmethod
+    def shared():
+        with MetaCache._shared_lock:
+            if(MetaCache._shared is None):
+                MetaCache._shared = MetaCache(MetaCache._connect())
+        return MetaCache._shared
+
+    @staticmethod
+    def _connect():
+        if(ButlerConfig.redis_setting("default", "metaCache", "false") != "true"):
+            return LocalRedis()
+
+        client = _connect_default_redis()
+        return client if client else LocalRedis()
+
+    @property
+    def client(self):
+        return self._client
+
+    def _key(self, namespace, key):
+        return "%s:%s:%s" % (MetaCache._PREFIX, namespace, key)
+
+    def get(self, namespace, key):
+        try:
+            value = self._client.get(self._key(namespace, key))
+        except Exception as err:
+            # A broken cache is only slower, never wrong.
+            #
+            print err
+            return None
+        return json.loads(value) if value is not None else None
+
+    def put(self, namespace, key, value, ttl=_META_CACHE_TTL):
+        try:
+            self._client.set(self._key(namespace, key), json.dumps(value), ex=ttl)
+        except Exception as err:
+            print err
+
+    def read_through(self, namespace, key, compute, ttl=_META_CACHE_TTL):
+        value = self.get(namespace, key)
+        if(value is None):
+            value = compute()
+            if(value is not None):
+                self.put(namespace, key, value, ttl)
+        return value
+
+class FileLock(object):
+    '''
+    Inter-process lock based on exclusive creation of a lock file, which works on every platform.
+    The lock file holds the pid of its owner and a token of the acquisition, the lock is released only
+    by its owner. A lock file older than stale seconds is treated as left by a crashed process and broken.
+    '''
+    def __init__(self, lockfile, timeout=60, stale=300):
+        self._lockfile = lockfile
+        self._timeout = timeout
+        self._stale = stale
+        self._token = None
+
+    def __enter__(self):
+        start = time.time()
+        token = "%d %s" % (os.getpid(), uuid.uuid4().hex)
+        while(True):
+            try:
+                fd = os.open(self._lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, token)
+                os.close(fd)
+                self._token = token
+                return self
+            except OSError as err:
+                if(err.errno != errno.EEXIST):
+                    raise
+                try:
+                    if(time.time() - os.stat(self._lockfile).st_mtime > self._stale):
+                        self._break_stale(token)
+                        continue
+                except OSError:
+                    # Released by its owner meanwhile, try again after the timeout check.
+                    #
+                    pass
+                if(time.time() - start > self._timeout):
+                    raise Exception("Timeout to acquire lock %s!" % self._lockfile)
+                time.sleep(0.05)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        taken = self._take("release", self._token)
+        if(taken is not None):
+            if(FileLock._read(taken) == self._token):
+                os.remove(taken)
+            else:
+                # Broken as stale and taken by another process, which owns it now.
+                #
+                self._put_back(taken)
+        self._token = None
+        return False
+
+    def _take(self, reason, token):
+        '''
+        Move the lock file to a name of our own, so that of several processes only one gets it.
+        return - string, the new path of the lock file, None if there is no lock file
+        '''
+        taken = "%s.%s.%s" % (self._lockfile, reason, token.replace(" ", "."))
+        try:
+            os.rename(self._lockfile, taken)
+        except OSError as err:
+            if(err.errno != errno.ENOENT):
+                raise
+            return None
+        return taken
+
+    def _break_stale(self, token):
+        # The lock file may have been released and taken again since it was found stale, a fresh one is put back.
+        #
+        taken = self._take("stale", token)
+        if(taken is not None):
+            if(time.time() - os.stat(taken).st_mtime > self._stale):
+                os.remove(taken)
+            else:
+                self._put_back(taken)
+
+    def _put_back(self, taken):
+        '''
+        Move a lock file taken by mistake back, unless the lock was acquired again meanwhile.
+        '''
+        try:
+            if(platform.system().upper() == "WINDOWS"):
+                os.rename(taken, self._lockfile)
+            else:
+                os.link(taken, self._lockfile)  # @UndefinedVariable
+                os.remove(taken)
+        except OSError as err:
+            if(err.errno != errno.EEXIST):
+                raise
+            os.remove(taken)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, "r") as f:
+                return f.read()
+        except IOError:
+            return None
 
 class FileManager(object):
     @staticmethod
@@ -210,9 +790,65 @@ class FileManager(object):
             print err
 
     @staticmethod
-    def gen_file_md5sum(filepath, save=True):
+    def new_digests():
+        '''
+        return - dict, a hashlib object of each algorithm of _CHECKSUM_ALGORITHMS, to be updated with
+                 the same blocks so that all the checksums are computed in one pass
+        '''
+        return dict((name, hashlib.new(name)) for name in _CHECKSUM_ALGORITHMS)
+
+    @staticmethod
+    def hexdigests(digests):
+        return dict((name, d.hexdigest()) for (name, d) in digests.items())
+
+    @staticmethod
+    def file_digests(filepath):
+        '''
+        return - dict, the hashlib objects of FileManager.new_digests updated with the file content
+        '''
+        digests = FileManager.new_digests()
+        with open(filepath, "rb") as f:
+            while(True):
+                block = f.read(_CHECKSUM_BLOCK_SIZE)
+                if(not block):
+                    break
+                for d in digests.values():
+                    d.update(block)
+        return digests
+
+    @staticmethod
+    def file_checksums(filepath):
+        '''
+        return - dict, {"md5":..., "sha1":..., "sha256":...} of the file content
+        '''
+        return FileManager.hexdigests(FileManager.file_digests(filepath))
+
+    @staticmethod
+    def files_checksums(filepaths, workers=_CHECKSUM_WORKERS):
+        '''
+        return - list of the checksums of each file, in the same order as filepaths
+        '''
+        return _concurrent_map(FileManager.file_checksums, filepaths, workers=workers)
+
+    @staticmethod
+    def verify_checksums(filepath, checksums, expected):
+        '''
+        Compare the checksums of a file with the ones artifactory reports, only the algorithms both
+        sides have are compared.
+        checksums - dict, checksums of the local file
+        expected - dict, i.e. the "checksums" of the artifactory storage api
+        '''
+        for name in _CHECKSUM_ALGORITHMS:
+            if(expected.get(name) and checksums.get(name) and expected[name].lower() != checksums[name]):
+                raise Exception("%s checksum of %s is %s, expected %s!" % (name, filepath, checksums[name], expected[name]))
+
+    @staticmethod
+    def gen_file_md5sum(filepath, save=True, md5=None):
+        '''
+        md5 - string, the md5 checksum if it is known already, otherwise the file content is hashed
+        '''
         target_md5sum_file = filepath + ".md5"
-        fchs = hashlib.md5(filepath).hexdigest()
+        fchs = md5 if md5 else FileManager.file_checksums(filepath)["md5"]
         if(save):
             FileManager.saveTextFile(target_md5sum_file, fchs)
         return fchs
@@ -225,6 +861,485 @@ class FileManager(object):
     def create_hard_link(src, dest):
         FileManager._create_link(src, dest, "link")
 
+class ArtifactoryClient(object):
+    '''
+    Artifactory REST client used instead of jfrog cli when "client" is "native" in the artifactory
+    configuration. Connections are pooled and files are transferred in parallel. An upload first
+    tries a checksum deploy, so the bytes of a file artifactory already stores are never sent
+    again, otherwise the file is streamed from disk.
+    '''
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    def __init__(self, url, apikey, workers=_ARTIFACTORY_WORKERS, timeout=_ARTIFACTORY_TIMEOUT):
+        self._url = url if url.endswith("/") else url + "/"
+        self._apikey = apikey
+        self._workers = workers
+        self._timeout = timeout
+        self._rest = PooledRestClient(pool_maxsize=workers, timeout=timeout)
+
+    @staticmethod
+    def for_server(server_id, workers=None):
+        '''
+        workers - int, parallel transfers, the connection pool of the client has as many connections
+        '''
+        workers = workers if workers else _ARTIFACTORY_WORKERS
+        with ArtifactoryClient._clients_lock:
+            if((server_id, workers) not in ArtifactoryClient._clients):
+                ArtifactoryClient._clients[(server_id, workers)] = ArtifactoryClient(ButlerConfig.artifactory_setting(server_id, "url"),
+                                                                                     ButlerConfig.artifactory_setting(server_id, "apiKey"),
+                                                                                     workers=workers)
+            return ArtifactoryClient._clients[(server_id, workers)]
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @staticmethod
+    def is_native(server_id):
+        return ButlerConfig.artifactory_setting(server_id, "client", "jfrog") == "native"
+
+    def _art_url(self, art_path):
+        return self._url + urllib.quote(art_path.lstrip("/"), safe="/")
+
+    def _headers(self, extra=None):
+        headers = {"X-JFrog-Art-Api": self._apikey}
+        if(extra):
+            headers.update(extra)
+        return headers
+
+    def upload_file(self, local_file, art_path):
+        '''
+        local_file - string, local file path
+        art_path - string, <repo>/<path in repo>
+        return - True if the content was sent, False if it was deployed by checksum
+        '''
+        with tracing.span("upload", "artifactory", art_path=art_path, bytes=os.path.getsize(local_file)) as span:
+            span.args["sent"] = self._upload_file(local_file, art_path)
+            return span.args["sent"]
+
+    def _upload_file(self, local_file, art_path):
+        checksums = FileManager.file_checksums(local_file)
+        headers = self._headers({"X-Checksum-Sha1": checksums["sha1"],
+                                 "X-Checksum-Sha256": checksums["sha256"],
+                                 "X-Checksum": checksums["md5"]})
+        url = self._art_url(art_path)
+        response = self._rest.session.put(url, headers=dict(headers, **{"X-Checksum-Deploy": "true"}), timeout=self._timeout)
+        if(response.ok):
+            return False
+        # Artifactory answers 404 when it doesn't have the checksum yet.
+        #
+        if(response.status_code != 404):
+            response.raise_for_status()
+
+        with open(local_file, "rb") as f:
+            response = self._rest.session.put(url, data=f, headers=headers, timeout=self._timeout)
+        response.raise_for_status()
+        return True
+
+    def upload_files(self, uploads):
+        '''
+        uploads - list of (local file path, <repo>/<path in repo>)
+        '''
+        return _concurrent_map(lambda upload: self.upload_file(upload[0], upload[1]), uploads, workers=self._workers)
+
+    def upload_spec(self, builddir, spec):
+        '''
+        Upload the files of a jfrog cli upload spec as "jfrog rt upload --flat=true" does: the pattern
+        is matched under builddir, a target ending with "/" is a folder.
+        spec - dict, {"files":[{"pattern":"test-1.0.0_b14-full.json", "target":"<repo>/com/test/1.0.0_b14/"}, ...]}
+        '''
+        uploads = []
+        for f in spec["files"]:
+            local_files = glob.glob(os.path.join(builddir, f["pattern"]))
+            if(not local_files):
+                raise Exception("No file matches %s!" % f["pattern"])
+            for local_file in local_files:
+                target = f["target"]
+                if(target.endswith("/")):
+                    target = target + os.path.basename(local_file)
+                uploads.append((local_file, target))
+        return self.upload_files(uploads)
+
+    def file_info(self, art_path):
+        '''
+        Query the storage api of the file.
+        art_path - string, <repo>/<path in repo>
+        return - dict, {"checksums": {"md5":..., "sha1":..., "sha256":...}, "size": "...", ...}
+        '''
+        response = self._rest.session.get(self._url + "api/storage/" + urllib.quote(art_path.lstrip("/"), safe="/"),
+                                          headers=self._headers(), timeout=self._timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def _download_part(self, art_path, part_file, digests):
+        '''
+        Download the rest of the file into part_file, starting where a previous attempt stopped.
+        digests - dict, the hashlib objects of the content of part_file, updated with the received blocks
+        '''
+        import requests
+        offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+        headers = self._headers({"Range": "bytes=%d-" % offset} if offset else None)
+        response = self._rest.session.get(self._art_url(art_path), headers=headers, stream=True, timeout=self._timeout)
+        try:
+            # 416 means part_file has the whole content already.
+            #
+            if(offset and response.status_code == 416):
+                return
+            response.raise_for_status()
+            # Servers ignoring the range send the whole file again.
+            #
+            if(offset and response.status_code == 206):
+                mode = "ab"
+            else:
+                mode = "wb"
+                digests.clear()
+                digests.update(FileManager.new_digests())
+            received = 0
+            with open(part_file, mode) as f:
+                for block in response.iter_content(_ARTIFACTORY_BLOCK_SIZE):
+                    f.write(block)
+                    received += len(block)
+                    for d in digests.values():
+                        d.update(block)
+            # A connection closed by the server early looks like the end of the content.
+            #
+            length = response.headers.get("Content-Length")
+            if(length and not response.headers.get("Content-Encoding") and received < int(length)):
+                raise requests.exceptions.ConnectionError("Received %d of %s bytes of %s" % (received, length, art_path))
+        finally:
+            response.close()
+
+    def download_file(self, art_path, local_file, retries=_ARTIFACTORY_RETRIES):
+        '''
+        Download the file to local_file.part and rename it to local_file once it is complete, so that
+        local_file is never partial. A dropped connection resumes with a range request from the end
+        of local_file.part, also the one left by a previous run.
+        return - dict, checksums of the downloaded content
+        '''
+        with tracing.span("download", "artifactory", art_path=art_path) as span:
+            checksums = self._download_file(art_path, local_file, retries)
+            span.args["bytes"] = os.path.getsize(local_file)
+            return checksums
+
+    def _download_file(self, art_path, local_file, retries):
+        import requests
+        part_file = local_file + ".part"
+        start = time.time()
+        if(os.path.isfile(part_file)):
+            resumed = os.path.getsize(part_file)
+            digests = FileManager.file_digests(part_file)
+        else:
+            resumed = 0
+            digests = FileManager.new_digests()
+
+        attempt = 0
+        while(True):
+            try:
+                self._download_part(art_path, part_file, digests)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout):
+                attempt += 1
+                if(attempt > retries):
+                    raise
+        received = max(os.path.getsize(part_file) - resumed, 0)
+        os.rename(part_file, local_file)
+        checksums = FileManager.hexdigests(digests)
+        elapsed = max(time.time() - start, 0.001)
+        print "Downloaded %s: %d bytes in %.2fs (%.1f KB/s)" % (art_path, received, elapsed, received / elapsed / 1024)
+        return checksums
+
+class ContentStore(object):
+    '''
+    Files downloaded from artifactory stored once by content under <datadir>/cas/<xx>/<sha1>. The
+    files of product versions are hard links into the store, so a component shared by consecutive
+    builds is only downloaded and stored once.
+    '''
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, storedir=None):
+        self._storedir = storedir if storedir else os.path.join(ButlerConfig.datadir(), "cas")
+
+    @staticmethod
+    def shared():
+        with ContentStore._shared_lock:
+            if(ContentStore._shared is None):
+                ContentStore._shared = ContentStore()
+            return ContentStore._shared
+
+    def path(self, sha1):
+        return os.path.join(self._storedir, sha1[:2], sha1)
+
+    def has(self, sha1):
+        return os.path.isfile(self.path(sha1))
+
+    def add(self, local_file, sha1):
+        '''
+        Move the content of local_file into the store, local_file becomes a link to the stored one.
+        The content of local_file must have been verified against sha1.
+        '''
+        stored = self.path(sha1)
+        if(not os.path.isdir(os.path.dirname(stored))):
+            try:
+                os.makedirs(os.path.dirname(stored))
+            except OSError:
+                if(not os.path.isdir(os.path.dirname(stored))):
+                    raise
+
+        if(not os.path.isfile(stored)):
+            tmp = "%s.%d.%d.tmp" % (stored, os.getpid(), threading.current_thread().ident)
+            try:
+                FileManager.create_hard_link(local_file, tmp)
+            except OSError:
+                # The store is on another device.
+                #
+                shutil.copy2(local_file, tmp)
+            os.rename(tmp, stored)
+        self.link(sha1, local_file)
+
+    def link(self, sha1, local_file):
+        '''
+        Make local_file a hard link of the stored content, falls back to a copy across devices.
+        '''
+        stored = self.path(sha1)
+        if(os.path.exists(local_file) and os.path.samefile(stored, local_file)):
+            return
+        if(not os.path.isdir(os.path.dirname(local_file))):
+            os.makedirs(os.path.dirname(local_file))
+        tmp = "%s.%d.%d.tmp" % (local_file, os.getpid(), threading.current_thread().ident)
+        try:
+            FileManager.create_hard_link(stored, tmp)
+        except OSError:
+            shutil.copy2(stored, tmp)
+        os.rename(tmp, local_file)
+
+class GitBatchReader(object):
+    '''
+    Long-lived "git cat-file --batch" process of one repository. Revisions are written to it and
+    the commit objects are parsed here, instead of spawning a git process for every query.
+    Requests and reads can be pipelined: the answers come back in the order of the requests.
+    Abbreviated commits are unique in the repository as "%h" of git: they start at the length git
+    abbreviates with, and are lengthened while the same process finds them ambiguous.
+    '''
+    def __init__(self, repodir, abbrev_length=None):
+        '''
+        abbrev_length - int, core.abbrev, computed from the objects of the repository like git by default
+        '''
+        self._repodir = repodir
+        self._process = subprocess.Popen(["git", "cat-file", "--batch"], cwd=repodir,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=_devnull())
+        self._abbrev_length = abbrev_length
+        self.gitdir_inode = None
+
+    @property
+    def repodir(self):
+        return self._repodir
+
+    def request(self, rev):
+        self._process.stdin.write("%s^{commit}\n" % rev)
+        self._process.stdin.flush()
+
+    def read_commit(self):
+        '''
+        return - (commit id, author email) of the oldest pending request
+        '''
+        header = self._process.stdout.readline()
+        parts = header.split()
+        if(len(parts) != 3):
+            raise Exception("Can't find commit %s in %s!" % (header.strip(), self._repodir))
+        (commit, objtype, size) = parts
+        body = self._read_body(size)
+        author = ""
+        for line in body.split("\n"):
+            if(not line):
+                break
+            if(line.startswith("author ")):
+                m = re.search("<([^>]*)>", line)
+                author = m.group(1) if m else ""
+                break
+        return (commit, author)
+
+    def _read_body(self, size):
+        body = self._process.stdout.read(int(size))
+        self._process.stdout.read(1)
+        return body
+
+    def min_abbrev_length(self):
+        if(self._abbrev_length is None):
+            try:
+                self._abbrev_length = abbrevLength(self._repodir)
+            except Exception:
+                self._abbrev_length = ABBREV_LENGTH
+        return self._abbrev_length
+
+    def request_abbrev(self, commit, length=None):
+        '''
+        Ask whether the prefix of commit of length (the minimum one by default) names no other object.
+        '''
+        self._process.stdin.write(commit[:length if length else self.min_abbrev_length()] + "\n")
+        self._process.stdin.flush()
+
+    def read_abbrev(self, commit):
+        '''
+        return - bool, whether the prefix of the oldest pending request_abbrev names commit and no other object
+        '''
+        # "<commit> commit <size>" and the object when the prefix is unique, "<prefix> ambiguous" (or
+        # "missing" with old git) otherwise.
+        #
+        parts = self._process.stdout.readline().split()
+        if(len(parts) == 3):
+            self._read_body(parts[2])
+            return parts[0] == commit
+        return False
+
+    def abbreviate(self, commit):
+        '''
+        No request may be pending.
+        return - string, the shortest prefix of commit, at least as long as git abbreviates, naming no other object
+        '''
+        for length in range(self.min_abbrev_length(), len(commit)):
+            self.request_abbrev(commit, length)
+            if(self.read_abbrev(commit)):
+                return commit[:length]
+        return commit
+
+    def commit(self, rev):
+        self.request(rev)
+        (commit, author) = self.read_commit()
+        return (commit, self.abbreviate(commit), author)
+
+    def close(self):
+        self._process.stdin.close()
+        self._process.wait()
+
+_devnull_file = None
+
+def _devnull():
+    global _devnull_file
+    if(_devnull_file is None):
+        _devnull_file = open(os.devnull, "w")
+    return _devnull_file
+
+class GitMetaReader(object):
+    '''
+    Commit metadata of the projects of a repo workspace, read through one GitBatchReader per
+    repository. The readers of the repositories of the latest queries are all kept, so that a
+    butler server reads the next build of the same workspace without starting any git process,
+    and the least recently used ones beyond that are closed. The readers of a butler run are
+    closed when it exits.
+    '''
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    # Queries whose requests are written before their answers are read.
+    #
+    _PIPELINE = 64
+
+    def __init__(self, max_readers=_PIPELINE):
+        '''
+        max_readers - readers kept at least, more are kept when one call reads more repositories
+        '''
+        self._max_readers = max_readers
+        self._readers = collections.OrderedDict()
+        self._abbrev_length = _MISSING
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def shared():
+        with GitMetaReader._shared_lock:
+            if(GitMetaReader._shared is None):
+                GitMetaReader._shared = GitMetaReader()
+                atexit.register(GitMetaReader._shared.close)
+        return GitMetaReader._shared
+
+    def _core_abbrev(self):
+        # An explicit core.abbrev of the user or the system applies to all the repositories, it is read once.
+        #
+        if(self._abbrev_length is _MISSING):
+            try:
+                value = _execute(["git", "config", "--get", "core.abbrev"], os.getcwd()).strip()
+                self._abbrev_length = int(value) if value.isdigit() else None
+            except Exception:
+                self._abbrev_length = None
+        return self._abbrev_length
+
+    def _reader(self, repodir):
+        repodir = os.path.abspath(repodir)
+        # A workspace wiped and synced again at the same path has new ".git" entries, the reader of
+        # the deleted repository would find none of its commits.
+        #
+        try:
+            gitdir_inode = os.stat(os.path.join(repodir, ".git")).st_ino
+        except OSError:
+            gitdir_inode = None
+        reader = self._readers.pop(repodir, None)
+        if(reader is not None and reader.gitdir_inode != gitdir_inode):
+            reader.close()
+            reader = None
+        if(reader is None):
+            reader = GitBatchReader(repodir, self._core_abbrev())
+            reader.gitdir_inode = gitdir_inode
+        self._readers[repodir] = reader
+        return reader
+
+    def commits(self, queries):
+        '''
+        queries - list of (repository directory, revision)
+        return - list of (abbreviated commit, author email) in the same order as queries
+        '''
+        results = []
+        with self._lock:
+            max_readers = max(self._max_readers, len(set(os.path.abspath(repodir) for (repodir, rev) in queries)))
+            _raise_open_files_limit(2 * max_readers)
+            # All the requests of a chunk are written before any answer is read, so that the
+            # git processes of the chunk work at the same time.
+            #
+            for start in range(0, len(queries), GitMetaReader._PIPELINE):
+                chunk = [(self._reader(repodir), rev) for (repodir, rev) in queries[start:start + GitMetaReader._PIPELINE]]
+                try:
+                    for (reader, rev) in chunk:
+                        reader.request(rev)
+                    commits = [reader.read_commit() for (reader, rev) in chunk]
+
+                    # The abbreviations are checked the same way, the few ambiguous ones are lengthened after.
+                    #
+                    for ((reader, rev), (commit, author)) in zip(chunk, commits):
+                        reader.request_abbrev(commit)
+                    unique = [reader.read_abbrev(commit) for ((reader, rev), (commit, author)) in zip(chunk, commits)]
+                    for ((reader, rev), (commit, author), found) in zip(chunk, commits, unique):
+                        abbrevcommit = commit[:reader.min_abbrev_length()] if found else reader.abbreviate(commit)
+                        results.append((abbrevcommit, author))
+                except Exception:
+                    # Answers still pending would be read by the next queries, drop the readers.
+                    #
+                    for (reader, rev) in chunk:
+                        if(self._readers.pop(reader.repodir, None)):
+                            reader.close()
+                    raise
+
+                while(len(self._readers) > max_readers):
+                    self._readers.popitem(last=False)[1].close()
+        return results
+
+    def close(self):
+        with self._lock:
+            while(self._readers):
+                self._readers.popitem()[1].close()
+
+def _raise_open_files_limit(descriptors):
+    '''
+    Raise the soft limit of open files up to the hard one, so that descriptors more pipes can be opened.
+    '''
+    try:
+        import resource
+        (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = descriptors + 256
+        if(soft != resource.RLIM_INFINITY and soft < wanted):
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard), hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
 class Repo(object):
     def __init__(self, name, commit, abbrev_commit, branch, author, pre_version):
         self._name = name
@@ -272,6 +1387,37 @@ class Repo(object):
         
     
 
+def _execute(cmdline, workdir, timeout=None):
+    '''
+    Run a command in workdir without changing the current directory of butler.
+    cmdline - list of arguments (or string run by shell)
+    return - string, output of the command
+    '''
+    return CMDPool.shared().run(cmdline, workdir, timeout)
+
+def _concurrent_map(func, items, workers=_JENKINS_FETCH_WORKERS, timeout=None):
+    '''
+    Apply func to every item with at most workers calls running at the same time.
+    func - callable taking one item
+    items - list
+    timeout - seconds to wait for each single result, None means wait forever
+    return - list of results in the same order as items
+    '''
+    if(len(items) <= 1):
+        return map(func, items)
+
+    from multiprocessing.pool import ThreadPool
+    func = _bind_to_worker(func)
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        asyncResults = [pool.apply_async(func, (item,)) for item in items]
+        # AsyncResult.get without timeout can't be interrupted by Ctrl+C in python 2,
+        # so always wait with a timeout even when the caller doesn't want one.
+        #
+        return [r.get(timeout if timeout else sys.maxint) for r in asyncResults]
+    finally:
+        pool.terminate()
+
 def _get_changed_repos(buildurl):
     '''
     Get all changed repos since last successful builds which deal with multi builds in parallel.
@@ -286,20 +1432,69 @@ def _get_changed_repos(buildurl):
         joburl = m.group(1)
         
     (jurl, juname, jpassword) = ButlerConfig.default_jenkins()
-        
-    jdata = SimpleRestClient.getJSONContent("%sapi/json?pretty=true" % joburl, juname, jpassword)
-    lastSuccessfulBuildNumber = jdata["lastSuccessfulBuild"]["number"]
-    for build in jdata["builds"]:
-        if(build["number"] > lastSuccessfulBuildNumber):
-            crepos = _get_changed_repos_of_build(build["url"])
-            for repo in crepos:
-                if(repo not in changedRepos):
-                    changedRepos.append(repo)
-        else:
-            break
+
+    # With "changesApi" set to "json" in jenkins configuration, the changes of all the builds are
+    # retrieved by one json api request instead of scraping the changes page of each build.
+    #
+    if(ButlerConfig.jenkins_setting("default", "changesApi", "html") == "json"):
+        buildsChangedRepos = _get_changed_repos_of_unsuccessful_builds(joburl)
+    else:
+        jdata = SimpleRestClient.getJSONContent("%sapi/json?tree=lastSuccessfulBuild[number],builds[number,url,building]" % joburl,
+                                                juname, jpassword, _JENKINS_TIMEOUT)
+        lastSuccessfulBuildNumber = jdata["lastSuccessfulBuild"]["number"]
+        builds = []
+        for build in jdata["builds"]:
+            if(build["number"] > lastSuccessfulBuildNumber):
+                builds.append(build)
+            else:
+                break
+
+        buildsChangedRepos = _get_changed_repos_of_builds(joburl, builds)
+
+    # The change pages are fetched concurrently, but merged in the order of the builds
+    # so that the result doesn't depend on which page comes back first.
+    #
+    seenRepos = set()
+    for crepos in buildsChangedRepos:
+        for repo in crepos:
+            if(repo not in seenRepos):
+                seenRepos.add(repo)
+                changedRepos.append(repo)
 
     return changedRepos
 
+def _get_changed_repos_of_builds(joburl, builds):
+    '''
+    Get changed repos of each build, only the builds never seen before are fetched from jenkins.
+    joburl - Jenkins job url (i.e. http://localhost:8080/jenkins/view/test/job/copd-multi/)
+    builds - list of dict, [{"number":9, "url":"http://localhost:8080/jenkins/view/test/job/copd-multi/9/", "building":False}, ...]
+    return - list of list of string, changed repos of each build in the same order as builds
+    '''
+    cache = BuildChangesCache()
+    metaCache = MetaCache.shared()
+    jobkey = hashlib.sha1(joburl.rstrip("/")).hexdigest()
+    # The changes of a build still running are not cached, they may be not complete yet.
+    #
+    buildsChangedRepos = [None if build.get("building", True) else cache.get(joburl, build["number"]) for build in builds]
+    for i in range(len(builds)):
+        if(buildsChangedRepos[i] is None and not builds[i].get("building", True)):
+            buildsChangedRepos[i] = metaCache.get("changes", "%s:%d" % (jobkey, builds[i]["number"]))
+            if(buildsChangedRepos[i] is not None):
+                cache.put(joburl, builds[i]["number"], buildsChangedRepos[i])
+
+    missingBuilds = [build for (build, crepos) in zip(builds, buildsChangedRepos) if crepos is None]
+    fetchedChangedRepos = iter(_concurrent_map(_get_changed_repos_of_build, [build["url"] for build in missingBuilds],
+                                               timeout=_JENKINS_TIMEOUT * 2))
+    for i in range(len(builds)):
+        if(buildsChangedRepos[i] is None):
+            buildsChangedRepos[i] = next(fetchedChangedRepos)
+            if(not builds[i].get("building", True)):
+                cache.put(joburl, builds[i]["number"], buildsChangedRepos[i])
+                metaCache.put("changes", "%s:%d" % (jobkey, builds[i]["number"]), buildsChangedRepos[i])
+
+    cache.evict()
+    return buildsChangedRepos
+
 def _get_changed_repos_of_build(buildurl):
     '''
     Get changed repos since last build.
@@ -309,7 +1504,7 @@ def _get_changed_repos_of_build(buildurl):
     changedRepos = []
     buildchangeurl = "%schanges" % buildurl
     (jurl, juname, jpassword) = ButlerConfig.default_jenkins()
-    data = SimpleRestClient.getStringContent(buildchangeurl, juname, jpassword)
+    data = SimpleRestClient.getStringContent(buildchangeurl, juname, jpassword, _JENKINS_TIMEOUT)
     pattern=r"Project:\s((?!\.repo).*)<br.*>"
     changesre = re.compile(pattern)
     if(changesre):
@@ -317,44 +1512,199 @@ def _get_changed_repos_of_build(buildurl):
 
     return changedRepos
 
-def _calculate_repos_buildneeded(builddir, currentRepos):
-    reposBuildNeeded = []
-    try:
-        repoGraphFile = builddir + os.sep + ".repo" + os.sep + "manifests" + os.sep + "repo_graph.json"
-        f = file(repoGraphFile,'r+');
-        s = json.load(f)
-        repoGraph = {}
-        for i in range(len(s)):
-            repoGraph["%s" % s[i]['name']] = s[i]['impact']
-            
-        if(currentRepos == "all"):
-            reposBuildNeeded = repoGraph.keys()
+def _get_changed_repos_of_unsuccessful_builds(joburl):
+    '''
+    Get changed repos of every build since last successful build with one jenkins json api request.
+    joburl - Jenkins job url (i.e. http://localhost:8080/jenkins/view/test/job/copd-multi/)
+    return - list of list of string, changed repos of each build from the latest build
+    '''
+    (jurl, juname, jpassword) = ButlerConfig.default_jenkins()
+    jdata = SimpleRestClient.getJSONContent("%sapi/json?tree=%s" % (joburl, _JENKINS_CHANGES_TREE), juname, jpassword, _JENKINS_TIMEOUT)
+    lastSuccessfulBuildNumber = jdata["lastSuccessfulBuild"]["number"]
+    buildsChangedRepos = []
+    for build in jdata["builds"]:
+        if(build["number"] > lastSuccessfulBuildNumber):
+            buildsChangedRepos.append(_get_changed_repos_of_changesets(build))
         else:
-            reposBuildNeeded = copy.deepcopy(currentRepos)
-            for r in reposBuildNeeded:
-                impactRepos = repoGraph[r]
-                if(impactRepos and len(impactRepos) > 0):
-                    for ir in impactRepos:
-                        if ir not in reposBuildNeeded:
-                            reposBuildNeeded.append(ir)
-    except  IOError as ioe:
-        message = "\nIOError: " + "[Errno " + str(ioe.errno) + "] " + ioe.strerror + ": " + ioe.filename
-        raise ioe
-    except Exception as e:
-        message = "Failed to generate build info property file!\n" + e.message
-        raise e
-    finally:
-        if(f):
-            f.close()
-            
-    return reposBuildNeeded
+            break
+
+    return buildsChangedRepos
+
+def _get_changed_repos_of_changesets(build):
+    '''
+    Get changed repos from the change sets of one build returned by jenkins json api.
+    build - dict, {"number":9, "changeSet":{"items":[{"serverPath":"test-repo1", ...}]}, "changeSets":[...]}
+    return - list of string
+    '''
+    changedRepos = []
+    changeSets = []
+    if(build.get("changeSet")):
+        changeSets.append(build["changeSet"])
+    if(build.get("changeSets")):
+        changeSets.extend(build["changeSets"])
+
+    for changeSet in changeSets:
+        for item in changeSet.get("items", []):
+            project = item.get("serverPath") or item.get("path")
+            if(not project):
+                continue
+            project = project.strip()
+            # Changes of the manifest project itself are not changes of any repo.
+            #
+            if(not project.startswith(".repo") and project not in changedRepos):
+                changedRepos.append(project)
+
+    return changedRepos
+
+class RepoGraph(object):
+    '''
+    Compiled form of repo_graph.json. The transitive impact closure of every repo is computed once
+    as a bitset (python long, bit i for the i-th repo), so resolving the repos impacted by any set of
+    changed repos is a few bitwise ors. Repos depending on each other are detected as cycles, they
+    all impact each other. Compiled graphs are kept per process by the sha1 of the graph file.
+    '''
+    _compiled = {}
+    _compiled_lock = threading.Lock()
+
+    def __init__(self, graph):
+        '''
+        graph - list of dict, [{"name":"test-repo1", "impact":["test-repo2", "test-repo3"]}, ...]
+        '''
+        self._names = []
+        self._index = {}
+        self._declared = []
+        edges = []
+        def _add(name):
+            if(name not in self._index):
+                self._index[name] = len(self._names)
+                self._names.append(name)
+                edges.append([])
+            return self._index[name]
+
+        for node in graph:
+            i = _add("%s" % node["name"])
+            self._declared.append(self._names[i])
+            for ir in (node["impact"] or []):
+                edges[i].append(_add(ir))
+
+        self._cycles = []
+        self._closures = [0] * len(self._names)
+        # Components are found in reverse topological order, so the closures of all the components
+        # a component impacts are always known when its own closure is computed.
+        #
+        for component in RepoGraph._strongly_connected_components(edges):
+            if(len(component) > 1 or component[0] in edges[component[0]]):
+                self._cycles.append(sorted(self._names[i] for i in component))
+            closure = 0
+            for i in component:
+                closure |= 1 << i
+            for i in component:
+                for j in edges[i]:
+                    closure |= self._closures[j]
+            for i in component:
+                self._closures[i] = closure
+
+        for cycle in self._cycles:
+            print "Cycle found in repo graph: %s" % ", ".join(cycle)
+
+    @staticmethod
+    def _strongly_connected_components(edges):
+        # Iterative Tarjan's algorithm, recursion would overflow the stack for long dependency chains.
+        #
+        index = [None] * len(edges)
+        lowlink = [0] * len(edges)
+        onStack = [False] * len(edges)
+        stack = []
+        components = []
+        counter = 0
+        for root in range(len(edges)):
+            if(index[root] is not None):
+                continue
+            work = [(root, 0)]
+            while(work):
+                (v, i) = work[-1]
+                if(i == 0):
+                    index[v] = lowlink[v] = counter
+                    counter += 1
+                    stack.append(v)
+                    onStack[v] = True
+                descended = False
+                while(i < len(edges[v])):
+                    w = edges[v][i]
+                    i += 1
+                    if(index[w] is None):
+                        work[-1] = (v, i)
+                        work.append((w, 0))
+                        descended = True
+                        break
+                    elif(onStack[w]):
+                        lowlink[v] = min(lowlink[v], index[w])
+                if(descended):
+                    continue
+
+                work.pop()
+                if(work):
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[v])
+                if(lowlink[v] == index[v]):
+                    component = []
+                    while(True):
+                        w = stack.pop()
+                        onStack[w] = False
+                        component.append(w)
+                        if(w == v):
+                            break
+                    components.append(component)
+        return components
+
+    @staticmethod
+    def load(repoGraphFile):
+        with open(repoGraphFile, "r") as f:
+            content = f.read()
+        key = hashlib.sha1(content).hexdigest()
+        with RepoGraph._compiled_lock:
+            if(key not in RepoGraph._compiled):
+                RepoGraph._compiled[key] = RepoGraph(json.loads(content))
+            return RepoGraph._compiled[key]
+
+    @property
+    def names(self):
+        return list(self._declared)
+
+    @property
+    def cycles(self):
+        return self._cycles
+
+    def impacted(self, changedRepos):
+        '''
+        changedRepos - list of string
+        return - list of string, the changed repos and all the repos they impact in graph order
+        '''
+        mask = 0
+        for r in changedRepos:
+            mask |= self._closures[self._index[r]]
+
+        impactedRepos = []
+        while(mask):
+            lowest = mask & -mask
+            impactedRepos.append(self._names[lowest.bit_length() - 1])
+            mask ^= lowest
+        return impactedRepos
+
+def _calculate_repos_buildneeded(builddir, currentRepos):
+    repoGraphFile = builddir + os.sep + ".repo" + os.sep + "manifests" + os.sep + "repo_graph.json"
+    repoGraph = RepoGraph.load(repoGraphFile)
+    if(currentRepos == "all"):
+        return repoGraph.names
+
+    return repoGraph.impacted(currentRepos)
 
 def _get_repos_buildneeded(builddir, buildurl, forcebuilds=None):
     reposneedbuild = [] 
     if(forcebuilds):
         reposneedbuild = _calculate_repos_buildneeded(builddir, forcebuilds)
     else:  
-        changedRepos = _get_changed_repos(buildurl)
+        changedRepos = SharedCalls.call(("jenkins changes", buildurl), lambda: _get_changed_repos(buildurl))
         if(changedRepos):
             reposneedbuild = _calculate_repos_buildneeded(builddir, changedRepos)
             
@@ -362,122 +1712,250 @@ def _get_repos_buildneeded(builddir, buildurl, forcebuilds=None):
 
 def _gen_prop_file(props, builddir, ofile='build-info.properties'):
     """
-    props - Dictionary, {'version.major':'9','version.minor':'50','version.build':'0015', ...}
+    Write the build info properties and their json sidecar, both atomically.
+    props - BuildInfo, or Dictionary {'product_name':'...','product_build_number':'15', ...}
     """
-    if(len(props) > 0):
-        f = None
-        try:
-            f = file(builddir + os.sep + ofile,'w+');
-            for (k,v) in props.items():
-                f.write(k + '=' + v + '\n')
-                
-            f.close()
-        except  IOError as ioe:
-            message = "\nIOError: " + "[Errno " + str(ioe.errno) + "] " + ioe.strerror + ": " + ioe.filename
-            raise Exception(message)
-        except Exception as e:
-            message = "Failed to generate build info property file!\n" + e.message
-            raise Exception(message)
-        finally:
-            if(f):
-                f.close()
-    else:
+    if(not props):
         message = "Your should provie an non-empty dict props"
         raise Exception(message)
+    try:
+        BuildInfo.fromProperties(props).save(builddir, ofile)
+    except Exception as e:
+        message = "Failed to generate build info property file!\n" + str(e)
+        raise Exception(message)
     
     
+def _is_commit_id(revision):
+    return re.match("^[0-9a-f]{40}$", revision) is not None
+
+def _load_manifest_packageinfo(manifestdir, rev):
+    '''
+    Load package.json of manifest repository at rev, the parsed package info is shared through
+    metadata cache by the manifest commit rev resolves to.
+    manifestdir - string, manifest repository directory (i.e. <builddir>/.repo/manifests)
+    rev - string, branch, tag or commit
+    return - dict
+    '''
+    commit = _execute(["git", "rev-parse", "--verify", "%s^{commit}" % rev], manifestdir).strip()
+
+    def _show_packageinfo():
+        output = _execute(["git", "--no-pager", "show", "%s:%s" % (commit, "package.json")], manifestdir)
+        return _deserialize_jsonobject_fromstring(output)
+
+    return MetaCache.shared().read_through("packageinfo", commit, _show_packageinfo)
+
+def _parse_manifest_projects(output):
+    '''
+    output - string, the manifest xml printed by "repo manifest -r"
+    return - list of xml.etree.ElementTree.Element, the project nodes
+    '''
+    import xml.etree.ElementTree as ET
+    root = ET.fromstring(output)
+    defaultNode = root.find('default')
+    if(defaultNode is None):
+        raise Exception("Can't find the default node from manifest")
+    return list(root.iter('project'))
+
 def _get_local_builddir_info(builddir, buildurl, manifest_branch, forcebuilds=None):
-    ps = PathStackMgr()
     output = ""
     repolist = []
     try:
-        ps.pushd(builddir + os.sep + ".repo" + os.sep + "manifests")
-        cmd = "git --no-pager show %s:%s" % (manifest_branch, "package.json")
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-        pre_packageinfo_s = _deserialize_jsonobject_fromstring(output)
+        pre_packageinfo_s = _load_manifest_packageinfo(builddir + os.sep + ".repo" + os.sep + "manifests", manifest_branch)
         repo_info = {}
         for r in pre_packageinfo_s["repos"]:
             rname = r["repoName"]
             repo_info[rname] = r["version"]
-        ps.popd()
 
-        cmd = "repo manifest -r"
-        ps.pushd(builddir)
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-        
-        root = ET.fromstring(output)
-        defaultNode = root.find('default')
-        if(defaultNode is None):
-            raise("Can't find the default node from manifest")
+        output = _repo_manifest(builddir)
+        projects = _parse_manifest_projects(output)
     
-        for project in root.iter('project'):
-            cmd = "git -C %s show -s --pretty=format:%%h_%%ae %s" % (project.attrib['name'], project.attrib['revision'])
-            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-            if(output):
-                output = output.strip()
-                loutput = output.split('_')
-                rname  = project.attrib['name']
-                repolist.append(Repo(rname, project.attrib['revision'], loutput[0], project.attrib['upstream'], loutput[1], repo_info[rname]))
+        # The abbreviated commit and author of a full commit id never change, so they are shared
+        # through metadata cache, the others are read in one pass through the git reader processes.
+        #
+        metaCache = MetaCache.shared()
+        commitInfos = [None] * len(projects)
+        for i in range(len(projects)):
+            if(_is_commit_id(projects[i].attrib['revision'])):
+                commitInfos[i] = metaCache.get(_COMMIT_INFO_CACHE, projects[i].attrib['revision'])
+
+        missing = [i for i in range(len(projects)) if commitInfos[i] is None]
+        queries = [(builddir + os.sep + projects[i].attrib.get('path', projects[i].attrib['name']), projects[i].attrib['revision']) for i in missing]
+        with tracing.span("git cat-file", "git", queries=len(queries)):
+            commitInfos_read = GitMetaReader.shared().commits(queries)
+        for (i, commitInfo) in zip(missing, commitInfos_read):
+            commitInfos[i] = list(commitInfo)
+            if(_is_commit_id(projects[i].attrib['revision'])):
+                metaCache.put(_COMMIT_INFO_CACHE, projects[i].attrib['revision'], commitInfos[i])
+
+        for (project, (abbrevcommit, author)) in zip(projects, commitInfos):
+            rname  = project.attrib['name']
+            repolist.append(Repo(rname, project.attrib['revision'], abbrevcommit, project.attrib['upstream'], author, repo_info[rname]))
         
     except Exception as err:
         print err
         raise err
-    finally:
-        ps.popd()
         
-    buildNeeded = _get_repos_buildneeded(builddir, buildurl, forcebuilds)
+    with tracing.span("repos_buildneeded", buildurl=buildurl):
+        buildNeeded = set(_get_repos_buildneeded(builddir, buildurl, forcebuilds))
     for repo in repolist:
         if(repo.name in buildNeeded):
             repo.buildneeded = True
     
     return repolist
 
-def _get_next_buildnumber(prodname, prodversion, builddir):
-    ps = PathStackMgr()
+class BuildNumberAllocator(object):
+    '''
+    Allocate the next (build number, unique build number) of a product version.
+
+    The "tags" allocator scans the tags of manifest repository every time. The "file" and "redis"
+    allocators keep one counter per product version and one per product for the unique build
+    number. Each counter is seeded once from the tags and then incremented atomically, under a lock
+    file in <datadir>/buildnumbers for "file" (safe among the builds of one agent) and by redis INCR
+    for "redis" (safe among the whole build farm).
+    '''
+    def __init__(self, prodname, prodversion, builddir):
+        self._prodname = prodname
+        self._prodversion = prodversion
+        self._builddir = builddir
+
+    @staticmethod
+    def create(prodname, prodversion, builddir, kind=None):
+        if(not kind):
+            kind = ButlerConfig.setting("buildNumberAllocator", "tags")
+
+        if(kind == "redis"):
+            client = _connect_default_redis()
+            if(client):
+                return RedisBuildNumberAllocator(prodname, prodversion, builddir, client)
+            print "Redis is not available to allocate build numbers, fall back to tags!"
+        elif(kind == "file"):
+            return FileBuildNumberAllocator(prodname, prodversion, builddir)
+        elif(kind != "tags"):
+            raise Exception("Unknown build number allocator %s!" % kind)
+
+        return BuildNumberAllocator(prodname, prodversion, builddir)
+
+    def allocate(self, reseed=False):
+        '''
+        reseed - bool, the tags were fetched since the last allocation (i.e. the previous numbers were rejected),
+                 the numbers must be after the latest tags
+        '''
+        return _get_next_buildnumber_from_tags(self._prodname, self._prodversion, self._builddir)
+
+class _CounterBuildNumberAllocator(BuildNumberAllocator):
+    '''
+    Base of the allocators keeping counters, the subclasses implement _next.
+    '''
+    __metaclass__ = ABCMeta
+
+    def allocate(self, reseed=False):
+        seeds = []
+        def _seed(index):
+            # Tags are only scanned when a counter doesn't exist yet or is reseeded, and at most once.
+            #
+            if(not seeds):
+                seeds.extend(_get_next_buildnumber_from_tags(self._prodname, self._prodversion, self._builddir))
+            return seeds[index] - 1
+
+        iBuildNumber = self._next("%s_%s_t" % (self._prodname, self._prodversion), lambda: _seed(0), reseed)
+        iUniqueBuildNumber = self._next("%s_u" % self._prodname, lambda: _seed(1), reseed)
+        return (iBuildNumber, iUniqueBuildNumber)
+
+    @abstractmethod
+    def _next(self, counter, seed, reseed):
+        '''
+        Increment the counter atomically.
+        counter - string, i.e. "<prodname>_<prodversion>_t"
+        seed - callable returning the value of the counter when it doesn't exist yet, the latest number of the tags
+        reseed - bool, the counter is moved to seed() first if it is behind
+        return - int, the incremented value
+        '''
+        pass
+
+class FileBuildNumberAllocator(_CounterBuildNumberAllocator):
+    def _next(self, counter, seed, reseed):
+        counterdir = os.path.join(ButlerConfig.datadir(), "buildnumbers")
+        if(not os.path.exists(counterdir)):
+            try:
+                os.makedirs(counterdir)
+            except OSError:
+                if(not os.path.isdir(counterdir)):
+                    raise
+
+        counterfile = os.path.join(counterdir, re.sub(r"[^\w.\-]", "_", counter))
+        with FileLock(counterfile + ".lock"):
+            if(os.path.exists(counterfile)):
+                with open(counterfile, "r") as f:
+                    current = int(f.read().strip())
+            else:
+                current = seed()
+            if(reseed):
+                current = max(current, seed())
+
+            current += 1
+            with open(counterfile + ".tmp", "w") as f:
+                f.write(str(current))
+            if(os.path.exists(counterfile)):
+                os.remove(counterfile)
+            os.rename(counterfile + ".tmp", counterfile)
+
+        return current
+
+class RedisBuildNumberAllocator(_CounterBuildNumberAllocator):
+    def __init__(self, prodname, prodversion, builddir, client):
+        _CounterBuildNumberAllocator.__init__(self, prodname, prodversion, builddir)
+        self._client = client
+
+    def _next(self, counter, seed, reseed):
+        key = "butler:buildnumber:%s" % counter
+        # Only the first of concurrent builds seeds the counter, all of them get distinct numbers from INCR.
+        #
+        if(self._client.get(key) is None):
+            self._client.set(key, seed(), nx=True)
+        current = int(self._client.incr(key))
+
+        # A counter behind the tags jumps past them with one more INCRBY, the numbers stay distinct.
+        #
+        if(reseed):
+            latest = seed()
+            if(current <= latest):
+                current = int(self._client.incr(key, latest + 1 - current))
+        return current
+
+def _get_next_buildnumber(prodname, prodversion, builddir, reseed=False):
+    return BuildNumberAllocator.create(prodname, prodversion, builddir).allocate(reseed)
+
+def _get_next_buildnumber_from_tags(prodname, prodversion, builddir):
     iBuildNumber = 1
     iUniqueBuildNumber = 1
-    output = ""
     try:
-        cmd = "git tag -l %s_%s_t* --sort=-version:refname" % (prodname, prodversion)
-        ucmd = "git tag -l %s_u* --sort=-version:refname" % (prodname)
-        ps.pushd(builddir + os.sep + ".repo" + os.sep + "manifests")
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-        uoutput = subprocess.check_output(ucmd, stderr=subprocess.STDOUT, shell=True)
-        if(output):
-            loutput = output.split('\n')
-            pretag = loutput[0]
-            pattern = "^%s_%s_t(.*)$" % (prodname, prodversion)
-            m = re.search(pattern, pretag)
-            if(m):
-                sBuildNumber = m.group(1)
-                iBuildNumber = int(sBuildNumber) + 1
-        
-        if(uoutput):
-            luoutput = uoutput.split('\n')
-            pretag = luoutput[0]
-            pattern = "^%s_u(.*)$" % (prodname)
-            m = re.search(pattern, pretag)
-            if(m):
-                sUniqueBuildNumber = m.group(1)
-                iUniqueBuildNumber = int(sUniqueBuildNumber) + 1
+        # Tags are read from the tag index of manifest repository, no git process is needed.
+        #
+        tagIndex = GitTagIndex.forWorkDir(builddir + os.sep + ".repo" + os.sep + "manifests")
+        latestBuildNumber = tagIndex.latestNumber("%s_%s_t" % (prodname, prodversion))
+        if(latestBuildNumber is not None):
+            iBuildNumber = latestBuildNumber + 1
+
+        latestUniqueBuildNumber = tagIndex.latestNumber("%s_u" % (prodname))
+        if(latestUniqueBuildNumber is not None):
+            iUniqueBuildNumber = latestUniqueBuildNumber + 1
         
     except Exception as err:
         print err
-    finally:
-        ps.popd()
     
     return (iBuildNumber, iUniqueBuildNumber)
 
 def _get_manifest_info(builddir):
-    ps = PathStackMgr()
     manifestUrl = ""
     manifestBranch = ""
     manifestRemoteBranch = ""
     manifestCommit = ""
     try:
-        cmd = "git remote -vv"
-        ps.pushd(builddir + os.sep + ".repo" + os.sep + "manifests")
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
+        manifestdir = builddir + os.sep + ".repo" + os.sep + "manifests"
+        (remoteOutput, branchOutput, commitOutput) = CMDPool.shared().runAll([(["git", "remote", "-vv"], manifestdir),
+                                                                              (["git", "branch", "-vv"], manifestdir),
+                                                                              (["git", "rev-parse", "HEAD"], manifestdir)])
+        output = remoteOutput
         if(output):
             loutput = output.split('\n')
             firstline = loutput[0]
@@ -486,8 +1964,7 @@ def _get_manifest_info(builddir):
             if(m):
                 manifestUrl = m.group(1)
         
-        cmd = "git branch -vv"
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
+        output = branchOutput
         if(output):
             pattern = "^\*\s(.+?)\s.*\[origin\/(.+)\]"
             m = re.search(pattern, output)
@@ -495,26 +1972,39 @@ def _get_manifest_info(builddir):
                 manifestBranch = m.group(1)
                 manifestRemoteBranch = m.group(2)
                 
-        cmd = "git rev-parse HEAD"
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
+        output = commitOutput
         if(output):
             manifestCommit = output.strip()
                 
         
     except Exception as err:
         print err
-    finally:
-        ps.popd()
     
     return (manifestUrl, manifestBranch, manifestRemoteBranch, manifestCommit)
 
 def get_buildinfo(prodname, prodversion, builddir, buildurl, forcebuilds=None):
-    (buildnumber, uniquebuildnumber) = _get_next_buildnumber(prodname, prodversion, builddir)
+    with tracing.span("next_buildnumber"):
+        (buildnumber, uniquebuildnumber) = _get_next_buildnumber(prodname, prodversion, builddir)
+    with tracing.span("manifest_info"):
+        manifestinfo = _get_manifest_info(builddir)
+    with tracing.span("local_builddir_info"):
+        blist = _get_local_builddir_info(builddir, buildurl, manifestinfo[1], forcebuilds)
+    props = _gen_buildinfo_props(prodname, prodversion, buildnumber, uniquebuildnumber, manifestinfo, blist)
+    _gen_prop_file(props, builddir)
+    
+    return props
+
+def _gen_buildinfo_props(prodname, prodversion, buildnumber, uniquebuildnumber, manifestinfo, blist):
+    '''
+    manifestinfo - (manifest url, manifest branch, manifest remote branch, manifest commit)
+    blist - list of Repo
+    return - BuildInfo, the build info properties
+    '''
     buildversion = "%s_b%s" % (prodversion, str(buildnumber))
     buildtag = "%s_%s_t%s" % (prodname, prodversion, str(buildnumber))
     ubuildtag = "%s_u%s" % (prodname, str(uniquebuildnumber))
-    manifesturl, manifestBranch, manifestRemoteBranch, manifestCommit = _get_manifest_info(builddir)
-    props={}
+    manifesturl, manifestBranch, manifestRemoteBranch, manifestCommit = manifestinfo
+    props = collections.OrderedDict()
     props['product_name'] = prodname
     props['product_version'] = prodversion
     props['product_build_needed'] = "false"
@@ -528,75 +2018,116 @@ def get_buildinfo(prodname, prodversion, builddir, buildurl, forcebuilds=None):
     props['product_manifest_branch'] = manifestBranch
     props['product_manifest_remote_branch'] = manifestRemoteBranch
     props['product_manifest_commit'] = manifestCommit
-    blist = _get_local_builddir_info(builddir, buildurl, manifestBranch, forcebuilds)
+    repos = []
     for b in blist:
-        props[_dash_to_underscore(b.name) + '_build_number'] = str(buildnumber)
-        props[_dash_to_underscore(b.name) + '_u_build_number'] = str(uniquebuildnumber)
-        props[_dash_to_underscore(b.name) + '_build_version'] = buildversion
-        props[_dash_to_underscore(b.name) + '_build_tag'] = buildtag
-        props[_dash_to_underscore(b.name) + '_u_build_tag'] = ubuildtag
-        props[_dash_to_underscore(b.name) + '_build_needed'] = str(b.buildneeded)
-        props[_dash_to_underscore(b.name) + '_build_commit'] = b.commit
-        props[_dash_to_underscore(b.name) + '_build_abbrevcommit'] = b.abbrevcommit
-        props[_dash_to_underscore(b.name) + '_build_commit_author'] = b.author
-        props[_dash_to_underscore(b.name) + '_build_branch'] = b.branch
+        repos.append(RepoBuildInfo(_dash_to_underscore(b.name),
+                                   buildNumber=buildnumber,
+                                   uBuildNumber=uniquebuildnumber,
+                                   buildVersion=buildversion,
+                                   buildTag=buildtag,
+                                   uBuildTag=ubuildtag,
+                                   buildNeeded=b.buildneeded,
+                                   commit=b.commit,
+                                   abbrevCommit=b.abbrevcommit,
+                                   commitAuthor=b.author,
+                                   branch=b.branch,
+                                   currentVersion=buildversion if b.buildneeded else b.preversion))
         if(b.buildneeded):
-            props[_dash_to_underscore(b.name) + '_build_current_version'] = buildversion
             props['product_build_needed'] = "true"
-        else:
-            props[_dash_to_underscore(b.name) + '_build_current_version'] = b.preversion
         
-    _gen_prop_file(props, builddir)
-    
-    return props
+    return BuildInfo(props, repos)
+
+def _renumber_buildinfo_props(props, buildnumber, uniquebuildnumber):
+    '''
+    Replace the build numbers of the build info properties, and the versions and tags made of them.
+    return - BuildInfo, the new build info properties
+    '''
+    prodname = props['product_name']
+    prodversion = props['product_version']
+    replacements = {props['product_build_version']: "%s_b%s" % (prodversion, str(buildnumber)),
+                    props['product_build_tag']: "%s_%s_t%s" % (prodname, prodversion, str(buildnumber)),
+                    props['product_u_build_tag']: "%s_u%s" % (prodname, str(uniquebuildnumber))}
+    oldbuildnumber = props['product_build_number']
+    olduniquebuildnumber = props['product_u_build_number']
+    newprops = collections.OrderedDict()
+    for (k, v) in props.items():
+        if(k.endswith('_u_build_number') and v == olduniquebuildnumber):
+            v = str(uniquebuildnumber)
+        elif(k.endswith('_build_number') and v == oldbuildnumber):
+            v = str(buildnumber)
+        else:
+            v = replacements.get(v, v)
+        newprops[k] = v
+    return BuildInfo.fromProperties(newprops)
 
-def create_pre_build_tag(builddir, props):
-    ps = PathStackMgr()
+def create_pre_build_tag(builddir, props, buildurl=None):
+    '''
+    Publish the build tag and the unique build tag with one atomic push. If another build published the same
+    numbers first, the tags are fetched, the numbers are allocated again after them, build-info.properties is
+    updated and the tags are pushed again. Raises when the tags can't be published.
+    buildurl - string, the message of the tags
+    return - dict, the build info properties of the published tags
+    '''
     try:
-        ps.pushd(builddir + os.sep + ".repo" + os.sep + "manifests")
-        cmd_tag1 = "git tag %s %s" % (props["product_build_tag"], props["product_manifest_commit"])
-        cmd_tag2 = "git tag %s %s" % (props["product_u_build_tag"], props["product_manifest_commit"])
-        subprocess.check_output(cmd_tag1, stderr=subprocess.STDOUT, shell=True)
-        subprocess.check_output(cmd_tag2, stderr=subprocess.STDOUT, shell=True)
-        cmd_push1 = "git push origin %s" % props["product_build_tag"]
-        cmd_push2 = "git push origin %s" % props["product_u_build_tag"]
-        subprocess.check_output(cmd_push1, stderr=subprocess.STDOUT, shell=True)
-        subprocess.check_output(cmd_push2, stderr=subprocess.STDOUT, shell=True)
-        ps.popd()
+        manifestdir = builddir + os.sep + ".repo" + os.sep + "manifests"
+        tagService = GitTagService(manifestdir)
+        for attempt in range(_TAG_PUSH_RETRIES + 1):
+            if(tagService.pushTags([props["product_build_tag"], props["product_u_build_tag"]], props["product_manifest_commit"], buildurl)):
+                return props
+
+            print "Tags %s and %s were rejected, allocate build numbers again." % (props["product_build_tag"], props["product_u_build_tag"])
+            tagService.fetchTags(["%s_%s_t*" % (props["product_name"], props["product_version"]), "%s_u*" % props["product_name"]])
+            (buildnumber, uniquebuildnumber) = _get_next_buildnumber(props["product_name"], props["product_version"], builddir, reseed=True)
+            props = _renumber_buildinfo_props(props, buildnumber, uniquebuildnumber)
+            _gen_prop_file(props, builddir)
+
+        raise Exception("Failed to publish the build tags after %d attempts!" % (_TAG_PUSH_RETRIES + 1))
     except Exception as err:
-        print err
-    finally:
-        ps.popd()
+        message = "Failed to create the pre-build tags!\n" + str(err)
+        raise Exception(message)
         
+def _fetch_manifest_branch(lmanifestdir, manifest_url, branch):
+    '''
+    Fetch the tip of the manifest branch into the persistent local manifest repository, creating it at the
+    first time. Only the tip commit is fetched, so every post-build costs one small fetch instead of a clone.
+    return - string, package.json of the tip commit (FETCH_HEAD)
+    '''
+    if(not os.path.isdir(os.path.join(lmanifestdir, ".git"))):
+        if(os.path.exists(lmanifestdir)):
+            shutil.rmtree(lmanifestdir)
+        _execute(["git", "init", lmanifestdir], os.path.dirname(lmanifestdir))
+
+    _execute(["git", "fetch", "--depth", "1", "--no-tags", manifest_url, "refs/heads/%s" % branch], lmanifestdir)
+    return _execute(["git", "--no-pager", "show", "FETCH_HEAD:package.json"], lmanifestdir)
+
 def create_post_build_tag(builddir, full_packageinfo_fn):
-    ps = PathStackMgr()
     try:
         props = _load_buildproperties(builddir + os.path.sep + "build-info.properties")
-        ps.pushd(builddir + os.path.sep + ".repo")
+        repodir = builddir + os.path.sep + ".repo"
+        lmanifestdir = repodir + os.path.sep + "lmanifest"
+        branch = props['product_manifest_remote_branch']
+        manifest_url = props['product_manifest_url']
 
-        if(os.path.exists("lmanifest")):
-            shutil.rmtree("lmanifest")
-
-        cmd_clone = "git clone -b %s %s lmanifest" % (props['product_manifest_remote_branch'], props['product_manifest_url'])
-        subprocess.check_output(cmd_clone, stderr=subprocess.STDOUT, shell=True)
-        latest_packageinfo = _deserialize_jsonobject("lmanifest" + os.path.sep + "package.json")
+        # .repo/lmanifest is kept between builds and only updated to the tip of the branch, the package.json of
+        # the tip is read from the fetched commit without checking it out.
+        #
+        latest_packageinfo = _deserialize_jsonobject_fromstring(_fetch_manifest_branch(lmanifestdir, manifest_url, branch))
         full_packageinfo = _deserialize_jsonobject(builddir + os.path.sep + full_packageinfo_fn)
         if(_compare_packageinfo(full_packageinfo, latest_packageinfo) == 1):
-            shutil.copyfile(builddir + os.path.sep + full_packageinfo_fn, builddir + os.sep + ".repo" + os.path.sep + "lmanifest" + os.path.sep + "package.json")
-            cmd_commit = "git -C lmanifest commit -a -m \"%s\"" % ("Update package.json with latest build " + props['product_name'] + "_" + props['product_build_version'])
-            cmd_tag = "git -C lmanifest tag %s" % (props['product_name'] + "_" + props['product_build_version'])
-            cmd_push_commit = "git -C lmanifest push"
-            cmd_push_tag = "git -C lmanifest push origin %s" % (props['product_name'] + "_" + props['product_build_version'])
-            subprocess.check_output(cmd_commit, stderr=subprocess.STDOUT, shell=True)
-            subprocess.check_output(cmd_tag, stderr=subprocess.STDOUT, shell=True)
-            subprocess.check_output(cmd_push_commit, stderr=subprocess.STDOUT, shell=True)
-            subprocess.check_output(cmd_push_tag, stderr=subprocess.STDOUT, shell=True)
-
-        ps.popd()
+            tag = props['product_name'] + "_" + props['product_build_version']
+            _execute(["git", "checkout", "-q", "-f", "-B", branch, "FETCH_HEAD"], lmanifestdir)
+            shutil.copyfile(builddir + os.path.sep + full_packageinfo_fn, lmanifestdir + os.path.sep + "package.json")
+            cmd_commit = ["git", "commit", "-a", "-m", "Update package.json with latest build " + tag]
+            cmd_tag = ["git", "tag", "-f", tag]
+            # The branch and the tag are updated together or not at all.
+            #
+            cmd_push = ["git", "push", "--atomic", manifest_url, "HEAD:refs/heads/%s" % branch, "refs/tags/%s" % tag]
+            _execute(cmd_commit, lmanifestdir)
+            _execute(cmd_tag, lmanifestdir)
+            _execute(cmd_push, lmanifestdir)
+
     except Exception as err:
         print err
-    finally:
-        ps.popd()
 
 def _serialize_jsonobject(jobject, outfile):
     try:
@@ -638,9 +2169,10 @@ def _deserialize_jsonobject_fromstring(invalue):
         raise e
             
 def _load_buildproperties(inpropfile):
-    prop = Property()
-    dict_prop = prop.load_property_files(inpropfile)
-    return dict_prop
+    '''
+    return - BuildInfo, read from the json sidecar of inpropfile when it is up to date
+    '''
+    return BuildInfo.load(os.path.dirname(inpropfile), os.path.basename(inpropfile))
 
 def _compare_packageinfo(packageinfo1, packageinfo2):
     # 1: greater than; 0: equal; -1: less than
@@ -661,24 +2193,252 @@ def _compare_packageinfo(packageinfo1, packageinfo2):
             
     return result
         
+class _PackageInfoRecord(object):
+    '''
+    Immutable record of package info (json) with __slots__. A changed record is a new one made by
+    replace(), so the unchanged records are shared by the full, increment and patch package infos
+    instead of copied. The json members without a slot are kept in _extra and written back as they
+    were.
+
+    A record made by from_json keeps its json: the records of its record fields (_RECORDS) and its
+    extra members are only made when they are first needed, and to_json() returns the json itself.
+    Most repos of a build are unchanged, their components are never made into records.
+    '''
+    __slots__ = ("_extra", "_json")
+    _FIELDS = ()
+    _RECORDS = {}
+    _PLAIN_FIELDS = {}
+
+    def __init__(self, extra=None, **fields):
+        setter = object.__setattr__
+        for name in self._FIELDS:
+            setter(self, name, fields.get(name))
+        setter(self, "_extra", extra)
+        setter(self, "_json", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __getattr__(self, name):
+        # Only the record fields of a record made by from_json are unset, until they are read.
+        #
+        record_cls = self._RECORDS.get(name)
+        if(record_cls is None):
+            raise AttributeError(name)
+        value = self._json.get(name)
+        if(value is not None):
+            if(isinstance(value, list)):
+                value = tuple([record_cls.from_json(v) for v in value])
+            else:
+                value = record_cls.from_json(value)
+        object.__setattr__(self, name, value)
+        return value
+
+    @classmethod
+    def _plain_fields(cls):
+        plain = _PackageInfoRecord._PLAIN_FIELDS.get(cls)
+        if(plain is None):
+            plain = _PackageInfoRecord._PLAIN_FIELDS[cls] = tuple(name for name in cls._FIELDS if name not in cls._RECORDS)
+        return plain
+
+    @classmethod
+    def from_json(cls, jobject):
+        if(isinstance(jobject, cls)):
+            return jobject
+        # Hundreds of thousands of records are made for big products, so the slots are set directly
+        # instead of through keyword arguments of __init__.
+        #
+        record = object.__new__(cls)
+        setter = object.__setattr__
+        get = jobject.get
+        for name in cls._plain_fields():
+            setter(record, name, get(name))
+        setter(record, "_extra", None)
+        setter(record, "_json", jobject)
+        return record
+
+    def _extra_members(self):
+        if(self._json is None):
+            return self._extra
+        extra = self._json.viewkeys() - self._FIELDS
+        return dict((name, self._json[name]) for name in extra) if extra else None
+
+    def json_member(self, name):
+        '''
+        return - the json of the member name if the record was made by from_json, None otherwise
+        '''
+        return None if self._json is None else self._json.get(name)
+
+    def replace(self, **changes):
+        record = object.__new__(self.__class__)
+        setter = object.__setattr__
+        for name in self._FIELDS:
+            setter(record, name, changes[name] if name in changes else getattr(self, name))
+        setter(record, "_extra", self._extra_members())
+        setter(record, "_json", None)
+        return record
+
+    def members(self):
+        '''
+        return - list of (name, value) of the json members, in the order of _FIELDS, missing members are skipped
+        '''
+        members = [(name, getattr(self, name)) for name in self._FIELDS if getattr(self, name) is not None]
+        extra = self._extra_members()
+        if(extra):
+            members.extend(extra.items())
+        return members
+
+    def to_json(self):
+        if(self._json is not None):
+            return self._json
+        jobject = {}
+        for (name, value) in self.members():
+            if(isinstance(value, _PackageInfoRecord)):
+                value = value.to_json()
+            elif(isinstance(value, tuple)):
+                value = [v.to_json() for v in value]
+            jobject[name] = value
+        return jobject
+
+class StorageInfo(_PackageInfoRecord):
+    __slots__ = ("groupId", "artifactId", "version", "classifier", "packaging")
+    _FIELDS = __slots__
+
+class ComponentInfo(_PackageInfoRecord):
+    __slots__ = ("name", "classifier", "packageLayout", "storage")
+    _FIELDS = __slots__
+    _RECORDS = {"storage": StorageInfo}
+
+    @property
+    def identity(self):
+        '''
+        return - tuple, a component is the same in two package infos if this tuple is the same
+        '''
+        return (self.name,
+                self.storage.groupId,
+                self.storage.artifactId,
+                self.storage.packaging,
+                self.storage.version,
+                self.storage.classifier,
+                self.packageLayout)
+
+    @staticmethod
+    def json_identity(jobject):
+        '''
+        return - tuple, the identity of the component json, without making its record
+        '''
+        storage = jobject["storage"]
+        get = storage.get
+        return (jobject.get("name"),
+                get("groupId"),
+                get("artifactId"),
+                get("packaging"),
+                get("version"),
+                get("classifier"),
+                jobject.get("packageLayout"))
+
+class RepoInfo(_PackageInfoRecord):
+    __slots__ = ("repoName", "commit", "author", "version", "components")
+    _FIELDS = __slots__
+    _RECORDS = {"components": ComponentInfo}
+
+class PackageInfo(_PackageInfoRecord):
+    __slots__ = ("product", "version", "buildNumber", "storage", "repos")
+    _FIELDS = __slots__
+    _RECORDS = {"storage": StorageInfo, "repos": RepoInfo}
+
+    @property
+    def file_name(self):
+        return "%s-%s-%s.%s" % (self.storage.artifactId, self.storage.version, self.storage.classifier, self.storage.packaging)
+
+    def write(self, f):
+        '''
+        Stream the package info as json to the file object, one repo at a time, so that the whole json
+        document is never built in memory.
+        '''
+        f.write("{")
+        first = True
+        for (name, value) in self.members():
+            if(not first):
+                f.write(", ")
+            first = False
+            f.write(json.dumps(name) + ": ")
+            if(name == "repos"):
+                f.write("[")
+                for i in range(len(value)):
+                    if(i > 0):
+                        f.write(", ")
+                    f.write(json.dumps(value[i].to_json()))
+                f.write("]")
+            elif(isinstance(value, _PackageInfoRecord)):
+                f.write(json.dumps(value.to_json()))
+            else:
+                f.write(json.dumps(value))
+        f.write("}")
+
+    def save(self, outfile):
+        with open(outfile, "w") as f:
+            self.write(f)
+
+def _get_patch_repos(pre_released_repos, full_build_repos):
+    '''
+    The repos and components of the full build that are not in the pre-released version.
+    pre_released_repos - list of RepoInfo, or of their json, repos of the pre-released package info
+    full_build_repos - list of RepoInfo, repos of the full build package info
+    return - tuple of RepoInfo, the whole repos added since the pre-released version, and the changed components of the others
+    '''
+    # Index each pre-released repo by its name, the first repo of a name wins. Most repos are unchanged since
+    # the pre-released version: their components json is the same, so the identities of the components are
+    # only computed for the others.
+    #
+    pre_released_index = {}
+    for pre_repo in pre_released_repos:
+        if(isinstance(pre_repo, RepoInfo)):
+            (name, components_json) = (pre_repo.repoName, pre_repo.json_member("components"))
+        else:
+            (name, components_json) = (pre_repo.get("repoName"), pre_repo.get("components"))
+        if(name not in pre_released_index):
+            pre_released_index[name] = (pre_repo, components_json)
+
+    def _pre_identities(pre_repo):
+        if(isinstance(pre_repo, RepoInfo)):
+            return set(c.identity for c in pre_repo.components)
+        return set(ComponentInfo.json_identity(c) for c in pre_repo.get("components") or ())
+
+    patch_repos = []
+    for repo in full_build_repos:
+        pre = pre_released_index.get(repo.repoName)
+        # A new git repo has been added in this version of software, so all the components should be included in current patch package info.
+        #
+        if(pre is None):
+            patch_repos.append(repo)
+            continue
+
+        (pre_repo, pre_components_json) = pre
+        components_json = repo.json_member("components")
+        if(components_json is not None and components_json == pre_components_json):
+            continue
+
+        # If the component was the same, it shouldn't be included in the patch package info.
+        #
+        pre_components = _pre_identities(pre_repo)
+        patch_components = tuple(c for c in repo.components if c.identity not in pre_components)
+        if(len(patch_components) > 0):
+            patch_repos.append(RepoInfo(repoName=repo.repoName, components=patch_components))
+
+    return tuple(patch_repos)
+
 def _gen_new_packageinfo(pre_released_packageinfo, pre_build_packageinfo, current_buildprops):
-    def _str_component(component):
-        component_s = "%s_%s_%s_%s_%s_%s_%s" % (component["name"],
-                                                component["storage"]["groupId"],
-                                                component["storage"]["artifactId"],
-                                                component["storage"]["packaging"],
-                                                component["storage"]["version"],
-                                                component["storage"]["classifier"],
-                                                component["packageLayout"])
-        return component_s
-
-    def _is_equal(component1, component2):
-        result = False
-        component1_s = _str_component(component1)
-        component2_s = _str_component(component2)
-        result = (component1_s == component2_s)
-
-        return result
+    '''
+    pre_released_packageinfo - dict or PackageInfo, None if there is no pre-released version
+    pre_build_packageinfo - dict or PackageInfo, package info of the manifest branch
+    current_buildprops - BuildInfo or dict, the build info properties of the current build
+    return - (full, increment, patch), PackageInfo of each, sharing their unchanged records
+    '''
+    current_buildprops = BuildInfo.fromProperties(current_buildprops)
+
+    def _is_build_needed(repo):
+        return current_buildprops.repo(repo.repoName).buildNeeded
 
     def _get_new_reposinfo(repo):
         # One git repository can generate one or more components, here we assume that once there is a change in
@@ -687,145 +2447,76 @@ def _gen_new_packageinfo(pre_released_packageinfo, pre_build_packageinfo, curren
         # However, there is one situation that a git repository can be used to generate different components that have different
         # version mechanism, for this kind of situation, usually different components are different software products.
         #
-        propname_prefix = _dash_to_underscore(repo["repoName"])
-        if(current_buildprops["%s_build_needed" % propname_prefix] == "True"):
-            repo["commit"] = current_buildprops["%s_build_commit" % propname_prefix]
-            repo["author"] = current_buildprops["%s_build_commit_author" % propname_prefix]
-            repo["version"] = current_buildprops["%s_build_version" % propname_prefix]
-            for component in repo["components"]:
-                component["storage"]["version"] = current_buildprops["%s_build_version" % propname_prefix]
-
-        return repo
-    
-    def _filter_incremental_repo(repo):
-        result = False
-        propname_prefix = _dash_to_underscore(repo["repoName"])
-        if(current_buildprops["%s_build_needed" % propname_prefix] == "True"):
-            result = True
-        return result
-    
-    def _get_patch_repos(full_build_packageinfo_repos):
-        patch_repos = []
-        pre_released_packageinfo_len = len(pre_released_packageinfo["repos"])
-        pre_released_packageinfo_index = 0
-        for repo in full_build_packageinfo_repos:
-            while(pre_released_packageinfo_index < pre_released_packageinfo_len):
-                # This git repo exists in both this version and previous version of software, so we check the components.
-                #
-                if(repo["repoName"] == pre_released_packageinfo["repos"][pre_released_packageinfo_index]["repoName"]):
-                    patch_components = []
-                    pre_released_components_len = len(pre_released_packageinfo["repos"][pre_released_packageinfo_index]["components"])
-                    pre_com_index = 0
-                    for com in repo["components"]:
-                        while (pre_com_index < pre_released_components_len):
-                            # If the component was the same, it shouldn't be included in the patch package info.
-                            #
-                            if(_is_equal(com, pre_released_packageinfo["repos"][pre_released_packageinfo_index]["components"][pre_com_index])):
-                                break
-                            pre_com_index += 1
-
-                        # If the component is different from previous components, it should be included included in the patch package info.
-                        #
-                        if(pre_com_index > pre_released_components_len - 1):
-                            patch_components.append(com)
-
-                        pre_com_index = 0
-                    if(len(patch_components) > 0):
-                        patch_repos.append({"repoName":repo["repoName"], "components":patch_components})
-
-                    break
-
-                pre_released_packageinfo_index += 1
-
-            # A new git repo has been added in this version of software, so all the components should be included in current patch package info.
-            #
-            if(pre_released_packageinfo_index > pre_released_packageinfo_len -1):
-                patch_repos.append(repo)
+        if(not _is_build_needed(repo)):
+            return repo
+
+        repo_buildinfo = current_buildprops.repo(repo.repoName)
+        version = repo_buildinfo.buildVersion
+        return repo.replace(commit=repo_buildinfo.commit,
+                            author=repo_buildinfo.commitAuthor,
+                            version=version,
+                            components=tuple(c.replace(storage=c.storage.replace(version=version)) for c in repo.components))
+
+    pre_build_packageinfo = PackageInfo.from_json(pre_build_packageinfo)
+    full_build_packageinfo = pre_build_packageinfo.replace(version=current_buildprops["product_version"],
+                                                           buildNumber=current_buildprops["product_build_number"],
+                                                           storage=pre_build_packageinfo.storage.replace(version=current_buildprops["product_build_version"],
+                                                                                                         classifier="full"),
+                                                           repos=tuple(_get_new_reposinfo(r) for r in pre_build_packageinfo.repos))
+
+    incremental_packageinfo = PackageInfo(product=full_build_packageinfo.product,
+                                          version=full_build_packageinfo.version,
+                                          buildNumber=full_build_packageinfo.buildNumber,
+                                          storage=full_build_packageinfo.storage.replace(classifier="increment"),
+                                          repos=tuple(r for r in full_build_packageinfo.repos if _is_build_needed(r)))
 
-            pre_released_packageinfo_index = 0
-
-        return patch_repos
-
-    def _gen_filter_patch_repo(pre_released_repoinfo):
-        def _filter_patch_repo(repo):
-            result = False
-            repoName = repo["repoName"]
-            if(repoName not in pre_released_repoinfo.keys()):
-                result = True
-            else:
-                for c in repo["components"]:
-                    cname = c["name"]
-                    if(cname not in pre_released_repoinfo[repoName].keys()):
-                        result = True
-                        break
-                    else:
-                        if(c["storage"]["version"] != pre_released_repoinfo[repoName][cname]["storage"]["version"]):
-                            result = True
-                            break
-            return result
-        return _filter_patch_repo
-
-    # return (full package info, patch package info, incremental package info)
-    full_build_packageinfo = copy.deepcopy(pre_build_packageinfo)
-    full_build_packageinfo["version"] = current_buildprops["product_version"]
-    full_build_packageinfo["buildNumber"] = current_buildprops["product_build_number"]
-    full_build_packageinfo["storage"]["version"] = current_buildprops["product_build_version"]
-    full_build_packageinfo["storage"]["classifier"] = "full"
-    full_build_packageinfo["repos"] = map(_get_new_reposinfo, full_build_packageinfo["repos"])
-    
-    incremental_packageinfo = {}
-    incremental_packageinfo["product"] = full_build_packageinfo["product"]
-    incremental_packageinfo["version"] = full_build_packageinfo["version"]
-    incremental_packageinfo["buildNumber"] = full_build_packageinfo["buildNumber"]
-    incremental_packageinfo["storage"] = copy.deepcopy(full_build_packageinfo["storage"])
-    incremental_packageinfo["storage"]["classifier"] = "increment"
-    incremental_packageinfo["repos"] = filter(_filter_incremental_repo, full_build_packageinfo["repos"])
-    
-    patch_packageinfo = copy.deepcopy(full_build_packageinfo)
-    patch_packageinfo["storage"]["classifier"] = "patch"
     if(pre_released_packageinfo):
-        patch_packageinfo = {}
-        patch_packageinfo["product"] = full_build_packageinfo["product"]
-        patch_packageinfo["version"] = full_build_packageinfo["version"]
-        patch_packageinfo["buildNumber"] = full_build_packageinfo["buildNumber"]
-        patch_packageinfo["storage"] = copy.deepcopy(full_build_packageinfo["storage"])
-        patch_packageinfo["storage"]["classifier"] = "patch"
-        patch_packageinfo["repos"] = _get_patch_repos(full_build_packageinfo["repos"])
-    
+        # Only the identities of the pre-released components are needed, they are read from the json
+        # instead of making records of the whole package info.
+        #
+        if(isinstance(pre_released_packageinfo, PackageInfo)):
+            pre_released_repos = pre_released_packageinfo.repos
+        else:
+            pre_released_repos = pre_released_packageinfo.get("repos") or ()
+        patch_packageinfo = PackageInfo(product=full_build_packageinfo.product,
+                                        version=full_build_packageinfo.version,
+                                        buildNumber=full_build_packageinfo.buildNumber,
+                                        storage=full_build_packageinfo.storage.replace(classifier="patch"),
+                                        repos=_get_patch_repos(pre_released_repos, full_build_packageinfo.repos))
+    else:
+        patch_packageinfo = full_build_packageinfo.replace(storage=full_build_packageinfo.storage.replace(classifier="patch"))
+
     return (full_build_packageinfo, incremental_packageinfo, patch_packageinfo)
 
 def upload_artifact_byspec(builddir, art_server_id, art_upload_spec_file):
-    ps = PathStackMgr()
     try:
-        ps.pushd(builddir)
-        cmd = "jfrog rt upload --flat=true --server-id=%s --spec=%s" % (art_server_id, art_upload_spec_file)
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-        ps.popd()
+        if(ArtifactoryClient.is_native(art_server_id)):
+            spec = _deserialize_jsonobject(os.path.join(builddir, art_upload_spec_file))
+            ArtifactoryClient.for_server(art_server_id).upload_spec(builddir, spec)
+            return
+
+        cmd = ["jfrog", "rt", "upload", "--flat=true", "--server-id=%s" % art_server_id, "--spec=%s" % art_upload_spec_file]
+        output = _execute(cmd, builddir)
     except Exception as err:
         print err
-    finally:
-        ps.popd()
         
 def upload_artifact_byfile(builddir, art_server_id, local_source_file, art_target_file):
-    ps = PathStackMgr()
     try:
-        ps.pushd(builddir)
-        cmd = "jfrog rt upload --flat=true --server-id=%s %s %s" % (art_server_id, local_source_file, art_target_file)
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-        ps.popd()
+        if(ArtifactoryClient.is_native(art_server_id)):
+            ArtifactoryClient.for_server(art_server_id).upload_spec(builddir, {"files":[{"pattern":local_source_file, "target":art_target_file}]})
+            return
+
+        cmd = ["jfrog", "rt", "upload", "--flat=true", "--server-id=%s" % art_server_id, local_source_file, art_target_file]
+        output = _execute(cmd, builddir)
     except Exception as err:
         print err
-    finally:
-        ps.popd()
         
 def download_artifact_byspec(builddir, art_server_id, art_download_spec_file):
-    ps = PathStackMgr()
     try:
-        ps.pushd(builddir)
-        cmd = "jfrog rt download --flat=false --server-id=%s --spec=%s" % (art_server_id, art_download_spec_file)
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
+        cmd = ["jfrog", "rt", "download", "--flat=false", "--server-id=%s" % art_server_id, "--spec=%s" % art_download_spec_file]
+        output = _execute(cmd, builddir)
         pattern = "^.+?\/(.+)$"
-        dobject = _deserialize_jsonobject(art_download_spec_file)
+        dobject = _deserialize_jsonobject(os.path.join(builddir, art_download_spec_file))
         for file in dobject["files"]:
             m = re.search(pattern, file["pattern"])
             partial_target_fp = ""
@@ -834,27 +2525,24 @@ def download_artifact_byspec(builddir, art_server_id, art_download_spec_file):
             else:
                 raise Exception("Can't find art source file!")
 
-            target_fp = file["target"] + partial_target_fp
+            target_fp = os.path.join(builddir, file["target"] + partial_target_fp)
             FileManager.gen_file_md5sum(target_fp)
-        ps.popd()
     except Exception as err:
         print err
-    finally:
-        ps.popd()
         
 def download_artifact_byfile(builddir, art_server_id, art_source_file, local_target_dir):
-    ps = PathStackMgr()
     try:
+        # A relative target directory is relative to builddir, where jfrog cli runs.
+        #
+        local_target_dir = os.path.join(builddir, local_target_dir)
         if(not os.path.isdir(local_target_dir)):
             raise Exception("%s is not a directory" % local_target_dir)
 
         if(local_target_dir.rfind("/") != len(local_target_dir)-1 and local_target_dir.rfind("\\") != len(local_target_dir)-1):
             local_target_dir = local_target_dir + os.path.sep
 
-        ps.pushd(builddir)
-        cmd = "jfrog rt download --flat=false --server-id=%s %s %s" % (art_server_id, art_source_file, local_target_dir)
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-        ps.popd()
+        cmd = ["jfrog", "rt", "download", "--flat=false", "--server-id=%s" % art_server_id, art_source_file, local_target_dir]
+        output = _execute(cmd, builddir)
         pattern = "^.+?\/(.+)$"
         m = re.search(pattern, art_source_file)
         partial_target_fp = ""
@@ -867,65 +2555,36 @@ def download_artifact_byfile(builddir, art_server_id, art_source_file, local_tar
         FileManager.gen_file_md5sum(target_fp)
     except Exception as err:
         print err
-    finally:
-        ps.popd()
 
 def pack_composite_product(builddir, base_prodtag):
-    ps = PathStackMgr()
     try:
         current_buildprops = _load_buildproperties(builddir + os.sep + "build-info.properties")
-        ps.pushd(builddir + os.sep + ".repo" + os.sep + "manifests")
-        cmd = "git --no-pager show %s:%s" % (current_buildprops["product_manifest_branch"], "package.json")
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-        pre_packageinfo_s = _deserialize_jsonobject_fromstring(output)
+        manifestdir = builddir + os.sep + ".repo" + os.sep + "manifests"
+        pre_packageinfo_s = _load_manifest_packageinfo(manifestdir, current_buildprops["product_manifest_branch"])
         
         base_packageinfo_s = None
         if(base_prodtag):
-            cmd = "git --no-pager show %s:%s" % (base_prodtag, "package.json")
-            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-            base_packageinfo_s = _deserialize_jsonobject_fromstring(output)
-        
-        ps.popd()
+            base_packageinfo_s = _load_manifest_packageinfo(manifestdir, base_prodtag)
 
         (full_packageinfo, increment_packageinfo, patch_packageinfo) = _gen_new_packageinfo(base_packageinfo_s, pre_packageinfo_s, current_buildprops)
 
-        full_packageinfo_fn = "%s-%s-%s.%s" % (full_packageinfo["storage"]["artifactId"],
-                                               full_packageinfo["storage"]["version"],
-                                               full_packageinfo["storage"]["classifier"],
-                                               full_packageinfo["storage"]["packaging"])
+        full_packageinfo_fn = full_packageinfo.file_name
+        increment_packageinfo_fn = increment_packageinfo.file_name
+        patch_packageinfo_fn = patch_packageinfo.file_name
 
-
-        increment_packageinfo_fn = "%s-%s-%s.%s" % (increment_packageinfo["storage"]["artifactId"],
-                                                    increment_packageinfo["storage"]["version"],
-                                                    increment_packageinfo["storage"]["classifier"],
-                                                    increment_packageinfo["storage"]["packaging"])
-
-
-        patch_packageinfo_fn = "%s-%s-%s.%s" % (patch_packageinfo["storage"]["artifactId"],
-                                               patch_packageinfo["storage"]["version"],
-                                               patch_packageinfo["storage"]["classifier"],
-                                               patch_packageinfo["storage"]["packaging"])
-
-        ps.pushd(builddir)
-        _serialize_jsonobject(full_packageinfo, full_packageinfo_fn)
-        _serialize_jsonobject(increment_packageinfo, increment_packageinfo_fn)
-        _serialize_jsonobject(patch_packageinfo, patch_packageinfo_fn)
-        ps.popd()
+        full_packageinfo.save(os.path.join(builddir, full_packageinfo_fn))
+        increment_packageinfo.save(os.path.join(builddir, increment_packageinfo_fn))
+        patch_packageinfo.save(os.path.join(builddir, patch_packageinfo_fn))
         return (full_packageinfo_fn, increment_packageinfo_fn, patch_packageinfo_fn)
     except Exception as err:
         print err
-    finally:
-        ps.popd()
         
 def upload_composite_product(builddir, full_packageinfo_fn, increment_packageinfo_fn, patch_packageinfo_fn):
-    ps = PathStackMgr()
     try:
-        ps.pushd(builddir)
-
         (repourl, art_server_id, art_download_repo, art_upload_repo) = ButlerConfig.default_artifactory()
-        full_packageinfo = _deserialize_jsonobject(full_packageinfo_fn)
-        increment_packageinfo = _deserialize_jsonobject(increment_packageinfo_fn)
-        patch_packageinfo = _deserialize_jsonobject(patch_packageinfo_fn)
+        full_packageinfo = _deserialize_jsonobject(os.path.join(builddir, full_packageinfo_fn))
+        increment_packageinfo = _deserialize_jsonobject(os.path.join(builddir, increment_packageinfo_fn))
+        patch_packageinfo = _deserialize_jsonobject(os.path.join(builddir, patch_packageinfo_fn))
 
         full_packageinfo_grouppath = full_packageinfo["storage"]["groupId"].replace(".", "/")
         full_packageinfo_artpath = "%s/%s/%s/%s/%s" % (art_upload_repo, 
@@ -951,48 +2610,371 @@ def upload_composite_product(builddir, full_packageinfo_fn, increment_packageinf
                                                        patch_packageinfo_fn)
         spec_f3 = {"pattern":patch_packageinfo_fn, "target":patch_packageinfo_artpath}
         art_upload_filespec = {"files":[spec_f1, spec_f2, spec_f3]}
-        _serialize_jsonobject(art_upload_filespec, "art_upload.spec")
+        _serialize_jsonobject(art_upload_filespec, os.path.join(builddir, "art_upload.spec"))
         upload_artifact_byspec(builddir, art_server_id, "art_upload.spec")
 
-        ps.popd()
     except Exception as err:
         raise
-    finally:
-        ps.popd()
 
-def pre_build_multi_repo(args):
+def _parse_forcebuilds(forcebuilds):
     lforcebuilds = None
-    if(args["forcebuilds"] and args["forcebuilds"] != "none"):
-        if(args["forcebuilds"] == "all"):
+    if(forcebuilds and forcebuilds != "none"):
+        if(forcebuilds == "all"):
             lforcebuilds = "all"
         else:
-            lforcebuilds = args["forcebuilds"].split(',')
-            
-    prodname = args["prodname"]
-    prodversion = args["prodversion"]
-    builddir = args["builddir"]
-    buildurl = args["buildurl"]
-    
+            lforcebuilds = forcebuilds.split(',')
+    return lforcebuilds
+
+def _pre_build(prodname, prodversion, builddir, buildurl, lforcebuilds):
     #
     # Need to be process safe.
     #
-    props = get_buildinfo(prodname, prodversion, builddir, buildurl, lforcebuilds)
-    create_pre_build_tag(builddir, props)
+    with tracing.span("get_buildinfo"):
+        props = get_buildinfo(prodname, prodversion, builddir, buildurl, lforcebuilds)
+    with tracing.span("create_pre_build_tag"):
+        create_pre_build_tag(builddir, props, buildurl)
     #
     # 
 
+def pre_build_multi_repo(args):
+    _pre_build(args["prodname"], args["prodversion"], args["builddir"], args["buildurl"], _parse_forcebuilds(args["forcebuilds"]))
+
+class SharedCalls(object):
+    '''
+    Calls shared by the products of one batch: a call with the same key as one already made, or still
+    running in another thread, waits for it and gets its result instead of being made again. Outside
+    of a batch every call is made.
+
+    with SharedCalls():
+        ...
+
+    The calls are shared by the thread entering it and the worker threads running its tasks (see bind), the
+    other commands of butler server and the other batches never see them.
+    '''
+    _local = threading.local()
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = SharedCalls.current()
+        SharedCalls._local.shared = self
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        SharedCalls._local.shared = self._previous
+        return False
+
+    @staticmethod
+    def current():
+        '''
+        return - SharedCalls, the one of the batch the calling thread works for, None outside of a batch
+        '''
+        return getattr(SharedCalls._local, "shared", None)
+
+    @staticmethod
+    def bind(func):
+        '''
+        return - callable, func sharing the calls of the calling thread
+        '''
+        shared = SharedCalls.current()
+        if(shared is None):
+            return func
+
+        def _shared(*args, **kwargs):
+            with shared:
+                return func(*args, **kwargs)
+        return _shared
+
+    @staticmethod
+    def call(key, func):
+        shared = SharedCalls.current()
+        return shared._call(key, func) if shared else func()
+
+    def _call(self, key, func):
+        with self._lock:
+            entry = self._calls.get(key)
+            owner = entry is None
+            if(owner):
+                entry = self._calls[key] = {"done": threading.Event()}
+        if(owner):
+            try:
+                entry["result"] = func()
+            except Exception as err:
+                entry["error"] = err
+            finally:
+                entry["done"].set()
+        else:
+            # Event.wait without timeout can't be interrupted by Ctrl+C in python 2.
+            #
+            entry["done"].wait(sys.maxint)
+        if("error" in entry):
+            raise entry["error"]
+        return entry["result"]
+
+def _repo_manifest(builddir):
+    '''
+    return - string, the output of "repo manifest -r" in builddir
+    '''
+    return SharedCalls.call(("repo manifest", os.path.abspath(builddir)),
+                            lambda: _execute(["repo", "manifest", "-r"], builddir))
+
+def _prefetch_commit_infos(builddirs):
+    '''
+    Read the abbreviated commit and author of the commits of all the build directories into the metadata
+    cache in one pass of the git readers, a commit shared by several manifests is read once. It is only an
+    optimization: the errors are printed, and each product reads what isn't cached and fails on its own errors.
+    '''
+    def _manifest_projects(builddir):
+        try:
+            return _parse_manifest_projects(_repo_manifest(builddir))
+        except Exception as err:
+            print "Commits of %s are not prefetched!" % builddir
+            print err
+            return []
+
+    metaCache = MetaCache.shared()
+    projects = _concurrent_map(_manifest_projects, builddirs)
+    queries = []
+    seen = set()
+    for (builddir, builddir_projects) in zip(builddirs, projects):
+        for project in builddir_projects:
+            revision = project.attrib['revision']
+            if(not _is_commit_id(revision) or revision in seen):
+                continue
+            seen.add(revision)
+            if(metaCache.get(_COMMIT_INFO_CACHE, revision) is None):
+                queries.append((builddir + os.sep + project.attrib.get('path', project.attrib['name']), revision))
+
+    try:
+        with tracing.span("git cat-file", "git", queries=len(queries)):
+            commitInfos = GitMetaReader.shared().commits(queries)
+    except Exception as err:
+        print "Commits of %s are not prefetched!" % ", ".join(builddirs)
+        print err
+        return
+    for ((repodir, revision), commitInfo) in zip(queries, commitInfos):
+        metaCache.put(_COMMIT_INFO_CACHE, revision, list(commitInfo))
+
+def _load_pre_build_batch(batchfile):
+    '''
+    batchfile - string, json list of {"prodname":..., "prodversion":..., "builddir":..., "buildurl":..., "forcebuilds":...}
+                or of [prodname, prodversion, builddir, buildurl], a relative builddir is relative to the batch file
+    return - list of dict
+    '''
+    entries = _deserialize_jsonobject(batchfile)
+    if(not isinstance(entries, list) or not entries):
+        raise Exception("%s should be a non-empty json list of products!" % batchfile)
+
+    products = []
+    for entry in entries:
+        if(isinstance(entry, list)):
+            entry = dict(zip(("prodname", "prodversion", "builddir", "buildurl"), entry))
+        product = dict((k, str(v)) for (k, v) in entry.items() if v is not None)
+        for name in ("prodname", "prodversion", "builddir", "buildurl"):
+            if(not product.get(name)):
+                raise Exception("%s of %s is missing in %s!" % (name, entry, batchfile))
+        product["builddir"] = os.path.join(os.path.dirname(os.path.abspath(batchfile)), product["builddir"])
+        products.append(product)
+
+    builddirs = [os.path.realpath(p["builddir"]) for p in products]
+    if(len(set(builddirs)) != len(builddirs)):
+        raise Exception("Products of %s share a build directory, their build-info.properties would overwrite each other!" % batchfile)
+    return products
+
+def pre_build_batch(args):
+    '''
+    Run pre_build_multi_repo for several products at the same time. Every product has its own build directory, what
+    they share is the commit prefetch: the commits of all their manifests are read in one pass before the products
+    start, a commit in several manifests once. The jenkins changes of products with the same build url are also
+    fetched once, and "repo manifest -r" of the prefetch is reused by the product of the build directory.
+    '''
+    products = _load_pre_build_batch(args["batchfile"])
+    workers = args.get("parallel") or _PRE_BUILD_BATCH_WORKERS
+
+    def _run_product(product):
+        try:
+            with tracing.span("pre_build %s" % product["prodname"], builddir=product["builddir"]):
+                _pre_build(product["prodname"], product["prodversion"], product["builddir"], product["buildurl"],
+                           _parse_forcebuilds(product.get("forcebuilds")))
+            return None
+        except Exception as err:
+            print "Pre-build of %s failed!" % product["prodname"]
+            print err
+            return product["prodname"]
+
+    with SharedCalls():
+        with tracing.span("prefetch_commit_infos", products=len(products)):
+            _prefetch_commit_infos([p["builddir"] for p in products])
+        failed = [f for f in _concurrent_map(_run_product, products, workers=workers) if f]
+
+    if(failed):
+        raise Exception("Pre-build of %d of %d products failed: %s" % (len(failed), len(products), ", ".join(failed)))
+
 def post_build_composite_product(args):
     builddir = args["builddir"]
     base_prodtag = args["prereleasedtag"]
-    (full_packageinfo_fn, increment_packageinfo_fn, patch_packageinfo_fn) = pack_composite_product(builddir, base_prodtag)
-    upload_composite_product(builddir, full_packageinfo_fn, increment_packageinfo_fn, patch_packageinfo_fn)
+    with tracing.span("pack_composite_product"):
+        (full_packageinfo_fn, increment_packageinfo_fn, patch_packageinfo_fn) = pack_composite_product(builddir, base_prodtag)
+    with tracing.span("upload_composite_product"):
+        upload_composite_product(builddir, full_packageinfo_fn, increment_packageinfo_fn, patch_packageinfo_fn)
     #
     # Need to be process safe.
     #
-    create_post_build_tag(builddir, full_packageinfo_fn)
+    with tracing.span("create_post_build_tag"):
+        create_post_build_tag(builddir, full_packageinfo_fn)
     #
     #
     
+def _download_artifacts(builddir, art_server_id, art_full_files, local_target_dir, workers=None):
+    '''
+    Download artifacts as "jfrog rt download --flat=false" does, through the content store: only the
+    artifacts whose sha1 isn't stored yet are downloaded, the others are linked from the store.
+    builddir - string, the directory where jfrog cli runs
+    art_full_files - list of string, <repo>/<path in repo>
+    local_target_dir - string, ends with os.sep
+    workers - int, parallel downloads, _ARTIFACTORY_WORKERS by default
+    return - list of the local files in the same order as art_full_files
+    '''
+    client = ArtifactoryClient.for_server(art_server_id, workers)
+    store = ContentStore.shared()
+    with tracing.span("file_info", files=len(art_full_files)):
+        infos = _concurrent_map(client.file_info, art_full_files, workers=client.workers)
+    local_files = [local_target_dir + art_full_file.split("/", 1)[1].replace("/", os.path.sep) for art_full_file in art_full_files]
+    missing = []
+    for (art_full_file, info, local_file) in zip(art_full_files, infos, local_files):
+        if(store.has(info["checksums"]["sha1"])):
+            store.link(info["checksums"]["sha1"], local_file)
+        else:
+            missing.append((art_full_file, info["checksums"], local_file))
+
+    if(not missing):
+        return local_files
+
+    # The native client hashes the files while they are downloaded, the files downloaded by jfrog cli are
+    # hashed afterwards in parallel. Either way each file is read once for all of its checksums.
+    #
+    if(ArtifactoryClient.is_native(art_server_id)):
+        def _download(item):
+            (art_full_file, expected, local_file) = item
+            if(not os.path.isdir(os.path.dirname(local_file))):
+                try:
+                    os.makedirs(os.path.dirname(local_file))
+                except OSError:
+                    pass
+            return client.download_file(art_full_file, local_file)
+        checksums = _concurrent_map(_download, missing, workers=client.workers)
+    else:
+        # jfrog cli runs in builddir, the target must not be relative to the current directory.
+        #
+        target = os.path.join(os.path.abspath(local_target_dir), "")
+        spec = {"files": [{"pattern": art_full_file, "target": target} for (art_full_file, expected, local_file) in missing]}
+        _serialize_jsonobject(spec, os.path.join(builddir, "product_download.spec"))
+        cmd = ["jfrog", "rt", "download", "--flat=false", "--threads=%d" % client.workers, "--server-id=%s" % art_server_id, "--spec=product_download.spec"]
+        _execute(cmd, builddir)
+        checksums = FileManager.files_checksums([local_file for (art_full_file, expected, local_file) in missing])
+
+    for ((art_full_file, expected, local_file), local_checksums) in zip(missing, checksums):
+        FileManager.verify_checksums(local_file, local_checksums, expected)
+        store.add(local_file, expected["sha1"])
+        FileManager.gen_file_md5sum(local_file, md5=local_checksums["md5"])
+    return local_files
+
+def _gen_composite_download_spec_ext(art_product_jobject, art_download_repo, local_target_dir):
+    '''
+    Go through the product package info(json) to find the components included in the product package.
+    return - dict, {"files":[{"pattern":<repo>/<component file>, "target":local_target_dir, "target_full_component_file":...,
+             "target_component_file":..., "product_component_layout":...}, ...]}
+    '''
+    art_download_spec_ext = {}
+    art_download_spec_ext["files"] = []
+    for repo in art_product_jobject["repos"]:
+        for component in repo["components"]:
+            # N/A means this option doesn't exist. If there was no package layout, that means this component
+            # of this product will be not included in the final product package. This component maybe a component
+            # that will be packaged in other components.
+            #
+            if(component["packageLayout"] == "N/A"):
+                continue
+
+            component_file_name = "{artifactId}-{version}{classifier}.{packaging}".format(artifactId = component["storage"]["artifactId"],
+                                                                                          version = component["storage"]["version"],
+                                                                                          classifier = "" if(component["storage"]["classifier"] == "N/A") else "-" + component["classifier"],
+                                                                                          packaging = component["storage"]["packaging"])
+            art_component_file = component["storage"]["groupId"].replace(".", "/") + "/" \
+                                + component["storage"]["artifactId"] + "/" \
+                                + component["storage"]["version"] + "/" \
+                                + component_file_name
+
+            art_full_component_file =  art_download_repo + "/" + art_component_file
+            local_component_file = art_component_file.replace("/", os.path.sep)
+            local_full_component_file = local_target_dir + local_component_file
+            art_download_spec_ext["files"].append({"pattern":art_full_component_file, 
+                                                   "target":local_target_dir, 
+                                                   "target_full_component_file":local_full_component_file, 
+                                                   "target_component_file":local_component_file, 
+                                                   "product_component_layout":component["packageLayout"]})
+    return art_download_spec_ext
+
+def _version_key(version):
+    '''
+    Sort key comparing the numbers in a version as numbers, i.e. 1.0.0_b9 < 1.0.0_b10
+    '''
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", version)]
+
+def _find_nearest_materialized_product(local_full_target_file):
+    '''
+    Find the package info file of the nearest other version of the product whose product folder was created
+    locally: the highest version below the requested one, otherwise the lowest one above it.
+    local_full_target_file - string, <local_target_dir>/<groupId path>/<artifactId>/<version>/<package info file>
+    return - string, the package info file of that version, None if there is no such version
+    '''
+    version_dir = os.path.dirname(local_full_target_file)
+    version = os.path.basename(version_dir)
+    artifact_dir = os.path.dirname(version_dir)
+    # The package info file and the product folder are named after the version.
+    #
+    (pattern_head, pattern_tail) = os.path.basename(local_full_target_file).split(version, 1)
+
+    candidates = []
+    for other_version in os.listdir(artifact_dir):
+        if(other_version == version):
+            continue
+        other_target_file = os.path.join(artifact_dir, other_version, pattern_head + other_version + pattern_tail)
+        other_product_dir = os.path.splitext(other_target_file)[0] + ".dir"
+        if(os.path.isfile(other_target_file) and os.path.isdir(other_product_dir)):
+            candidates.append((_version_key(other_version), other_target_file))
+
+    lower = [c for c in candidates if c[0] < _version_key(version)]
+    if(lower):
+        return max(lower)[1]
+    if(candidates):
+        return min(candidates)[1]
+    return None
+
+def _get_incremental_component_files(local_full_target_file, art_download_repo, local_target_dir, art_download_spec_ext):
+    '''
+    Diff the package info of the product with the one of the nearest materialized version.
+    return - list of string, the components to download: the ones whose storage coordinates are not in the nearest
+             version, or whose local files are gone
+    '''
+    base_target_file = _find_nearest_materialized_product(local_full_target_file)
+    if(base_target_file is None):
+        print "No materialized version found, download all components."
+        return [f["pattern"] for f in art_download_spec_ext["files"]]
+
+    base_jobject = _deserialize_jsonobject(base_target_file)
+    base_files = set(f["pattern"] for f in _gen_composite_download_spec_ext(base_jobject, art_download_repo, local_target_dir)["files"])
+    changed = []
+    for f in art_download_spec_ext["files"]:
+        if(f["pattern"] not in base_files or not os.path.isfile(f["target_full_component_file"])):
+            changed.append(f["pattern"])
+    print "Incremental from %s: %d changed, %d unchanged components." % (os.path.basename(base_target_file), len(changed),
+                                                                         len(art_download_spec_ext["files"]) - len(changed))
+    return changed
+
 def download_composite_product(args):
     """
     :param builddir: string, build directory
@@ -1002,6 +2984,11 @@ def download_composite_product(args):
     builddir = args["workdir"] if args["workdir"] else  ButlerConfig.datadir()
     art_source_file = args["rpath"]
     local_target_dir = args["tdir"] if args["tdir"] else  ButlerConfig.datadir()
+    # A relative target directory is relative to builddir, where the artifacts are downloaded. It is made
+    # absolute here, so that the helpers joining it with builddir again or running jfrog cli in builddir
+    # get the same directory.
+    #
+    local_target_dir = os.path.abspath(os.path.join(builddir, local_target_dir))
 
     if(not os.path.isdir(local_target_dir)):
         raise Exception("%s is not a directory" % local_target_dir)
@@ -1009,79 +2996,63 @@ def download_composite_product(args):
     if(local_target_dir.rfind("/") != len(local_target_dir)-1 and local_target_dir.rfind("\\") != len(local_target_dir)-1):
         local_target_dir = local_target_dir + os.path.sep
 
-    ps = PathStackMgr()
     try:
         (repourl, art_server_id, art_download_repo, art_upload_repo) = ButlerConfig.default_artifactory()
 
-        ps.pushd(builddir)
         # No matter it is single or composite product, we need to download it firstly!
         # The source file path of product artifact or the in artifactory started from artifactory download
         # repo which we think it as the full path, because jfrog cli treat it like this way.
         #
         art_full_source_file = art_download_repo + "/" + art_source_file
 
-        # Download the product's artifact from artifactory
-        #
-        download_artifact_byfile(builddir, art_server_id, art_full_source_file, local_target_dir)
-        
-        # Well it is a composite product, the downloaded artifact above is just the product's package info file(json)
+        # Well it is a composite product, the downloaded artifact below is just the product's package info file(json)
         #
         # After downloaded the product's package info file (json) from artifactory, local_full_target_file was calculated
         # to be its local full path on current runninng operation system which we need to convert the path's seperation.
         #
         local_full_target_file = local_target_dir + art_source_file.replace("/", os.path.sep)
 
-        # Load the product's pacakge info file(json) to generate artifactory download spec file to download real components
-        # included in this package info file.
+        # Download the product's artifact from artifactory. A released product version never changes, so once one agent
+        # has downloaded its package info file, the others take it from metadata cache.
         #
-        art_product_jobject = _deserialize_jsonobject(local_full_target_file)
-        # This dictionary will store the real download spec info
+        metaCache = MetaCache.shared()
+        product_key = "%s:%s" % (art_server_id, art_full_source_file)
+        art_product_content = metaCache.get("productinfo", product_key)
+        if(art_product_content is None):
+            download_artifact_byfile(builddir, art_server_id, art_full_source_file, local_target_dir)
+            with open(local_full_target_file, "r") as f:
+                art_product_content = f.read()
+            metaCache.put("productinfo", product_key, art_product_content)
+        elif(not os.path.exists(local_full_target_file)):
+            if(not os.path.exists(os.path.dirname(local_full_target_file))):
+                os.makedirs(os.path.dirname(local_full_target_file))
+            FileManager.saveTextFile(local_full_target_file, art_product_content)
+            FileManager.gen_file_md5sum(local_full_target_file)
+
+        # Load the product's pacakge info file(json) to find the real components included in this package info file.
         #
-        art_download_spec = {}
-        art_download_spec["files"] = []
+        art_product_jobject = _deserialize_jsonobject_fromstring(art_product_content)
         # An extended one of the download spec file to record more info in order to create symbolic link of the real
         # component file from product folder
         #
-        art_download_spec_ext = {}
-        art_download_spec_ext["files"] = []
-        # Go through the product package info(json) to fill the download spec objects
-        #
-        for repo in art_product_jobject["repos"]:
-            for component in repo["components"]:
-                # N/A means this option doesn't exist. If there was no package layout, that means this component
-                # of this product will be not included in the final product package. This component maybe a component
-                # that will be packaged in other components.
-                #
-                if(component["packageLayout"] == "N/A"):
-                    continue
+        art_download_spec_ext = _gen_composite_download_spec_ext(art_product_jobject, art_download_repo, local_target_dir)
+        art_full_component_files = [f["pattern"] for f in art_download_spec_ext["files"]]
 
-                component_file_name = "{artifactId}-{version}{classifier}.{packaging}".format(artifactId = component["storage"]["artifactId"],
-                                                                                              version = component["storage"]["version"],
-                                                                                              classifier = "" if(component["storage"]["classifier"] == "N/A") else "-" + component["classifier"],
-                                                                                              packaging = component["storage"]["packaging"])
-                art_component_file = component["storage"]["groupId"].replace(".", "/") + "/" \
-                                    + component["storage"]["artifactId"] + "/" \
-                                    + component["storage"]["version"] + "/" \
-                                    + component_file_name
-
-                art_full_component_file =  art_download_repo + "/" + art_component_file
-                local_component_file = art_component_file.replace("/", os.path.sep)
-                local_full_component_file = local_target_dir + local_component_file
-                art_download_spec["files"].append({"pattern":art_full_component_file, "target":local_target_dir})
-                art_download_spec_ext["files"].append({"pattern":art_full_component_file, 
-                                                       "target":local_target_dir, 
-                                                       "target_full_component_file":local_full_component_file, 
-                                                       "target_component_file":local_component_file, 
-                                                       "product_component_layout":component["packageLayout"]})
+        # In incremental mode only the components which are not in the nearest version materialized locally are
+        # downloaded, the files of the others are already in place and just linked into the new product folder.
+        #
+        if(args.get("incremental")):
+            art_full_component_files = _get_incremental_component_files(local_full_target_file, art_download_repo,
+                                                                        local_target_dir, art_download_spec_ext)
         
         # Now let's create the product folder in which we will create all the package layouts and make symbolic links
         # to each real components, so that we won't keep double component artifacts in local cached folder unless we
         # call another commands to make the real product package.
         
-        # If the product folder doens't exist, create it!
-        #        
-        _serialize_jsonobject(art_download_spec, "product_download.spec")
-        download_artifact_byspec(builddir, art_server_id, "product_download.spec")
+        # If the product folder doens't exist, create it! Components already in the content store are linked instead
+        # of downloaded again.
+        #
+        _download_artifacts(builddir, art_server_id, art_full_component_files, local_target_dir, args.get("parallel"))
         local_full_product_dir = local_target_dir \
                                 + art_product_jobject["storage"]["groupId"].replace(".", os.path.sep) \
                                 + os.path.sep \
@@ -1107,11 +3078,8 @@ def download_composite_product(args):
                     
                 FileManager.create_hard_link(f["target_full_component_file"], local_full_product_component_file)
 
-        ps.popd()
     except Exception as err:
         print err
-    finally:
-        ps.popd()
 
 def download_single_product(args):
     """
@@ -1122,6 +3090,11 @@ def download_single_product(args):
     builddir = args["workdir"] if args["workdir"] else  ButlerConfig.datadir()
     art_source_file = args["rpath"]
     local_target_dir = args["tdir"] if args["tdir"] else  ButlerConfig.datadir()
+    # A relative target directory is relative to builddir, where the artifacts are downloaded. It is made
+    # absolute here, so that the helpers joining it with builddir again or running jfrog cli in builddir
+    # get the same directory.
+    #
+    local_target_dir = os.path.abspath(os.path.join(builddir, local_target_dir))
 
     if(not os.path.isdir(local_target_dir)):
         raise Exception("%s is not a directory" % local_target_dir)
@@ -1129,38 +3102,244 @@ def download_single_product(args):
     if(local_target_dir.rfind("/") != len(local_target_dir)-1 and local_target_dir.rfind("\\") != len(local_target_dir)-1):
         local_target_dir = local_target_dir + os.path.sep
 
-    ps = PathStackMgr()
     try:
         (repourl, art_server_id, art_download_repo, art_upload_repo) = ButlerConfig.default_artifactory()
 
-        ps.pushd(builddir)
         # No matter it is single or composite product, we need to download it firstly!
         # The source file path of product artifact or the in artifactory started from artifactory download
         # repo which we think it as the full path, because jfrog cli treat it like this way.
         #
         art_full_source_file = art_download_repo + "/" + art_source_file
 
-        # Download the product's artifact from artifactory
+        # Download the product's artifact from artifactory unless the content store already has it.
         #
-        download_artifact_byfile(builddir, art_server_id, art_full_source_file, local_target_dir)
+        _download_artifacts(builddir, art_server_id, [art_full_source_file], local_target_dir, args.get("parallel"))
 
-        ps.popd()
     except Exception as err:
         print err
+
+# Arguments of the commands which are paths relative to the current directory of the client, butler server resolves
+# them against the directory of the client. "tdir" is relative to "workdir", not to the current directory.
+#
+_PATH_ARGS = ("builddir", "workdir", "batchfile", "trace", "profile")
+
+def _send_message(sock, message):
+    '''
+    Send a json message prefixed by its length (4 bytes, network order).
+    '''
+    data = json.dumps(message)
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while(size > 0):
+        chunk = sock.recv(min(size, 65536))
+        if(not chunk):
+            raise Exception("Connection closed before the whole message was received!")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+def _recv_message(sock):
+    '''
+    return - the json message, None if the peer closed the connection without sending anything
+    '''
+    header = sock.recv(4)
+    if(not header):
+        return None
+    (size,) = struct.unpack("!I", header + _recv_exactly(sock, 4 - len(header)))
+    return json.loads(_recv_exactly(sock, size))
+
+class _ThreadOutput(object):
+    '''
+    sys.stdout and sys.stderr of butler server. What the thread of a request, and the worker threads running its
+    tasks (see bind), print is captured to be sent back to its client, the other threads print to the original stream.
+    '''
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def capture(self, buf):
+        self._local.buf = buf
+
+    def release(self):
+        self._local.buf = None
+
+    def bind(self, func):
+        '''
+        return - callable, func printing to the output captured by the calling thread
+        '''
+        buf = getattr(self._local, "buf", None)
+        if(buf is None):
+            return func
+
+        def _captured(*args, **kwargs):
+            previous = getattr(self._local, "buf", None)
+            self._local.buf = buf
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.buf = previous
+        return _captured
+
+    def write(self, data):
+        buf = getattr(self._local, "buf", None)
+        if(buf is None):
+            self._stream.write(data)
+            return
+        # The worker threads of a request write to the same buffer.
+        #
+        with self._lock:
+            buf.write(data)
+
+    def flush(self):
+        if(getattr(self._local, "buf", None) is None):
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+def _bind_to_worker(func):
+    '''
+    return - callable, func running in a worker thread with the tracer, the captured output and the shared calls of
+             the calling thread
+    '''
+    func = SharedCalls.bind(tracing.bind(func))
+    for stream in (sys.stdout, sys.stderr):
+        if(isinstance(stream, _ThreadOutput)):
+            func = stream.bind(func)
+    return func
+
+class _ButlerRequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        request = _recv_message(self.request)
+        if(request is None):
+            # ButlerServer.connect() checking whether the server is running.
+            #
+            return
+        output = StringIO.StringIO()
+        status = 0
+        sys.stdout.capture(output)
+        sys.stderr.capture(output)
+        try:
+            ButlerConfig.reload_if_changed()
+            _run([arg.encode("utf-8") for arg in request["argv"]], request["cwd"].encode("utf-8"))
+        except SystemExit as err:
+            # argparse exits on bad arguments and --help.
+            #
+            status = err.code if isinstance(err.code, int) else (0 if err.code is None else 1)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.release()
+            sys.stderr.release()
+        _send_message(self.request, {"status": status, "output": output.getvalue().decode("utf-8", "replace")})
+
+class ButlerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''
+    "butler serve": run the ci/cd commands forwarded by butler clients on a unix socket, each in its own
+    thread. The configuration, http connection pools, git reader processes, metadata cache and compiled
+    repo graphs stay warm between commands instead of being built again by every butler process.
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        if(os.path.exists(socket_path)):
+            sock = ButlerServer.connect(socket_path)
+            if(sock):
+                sock.close()
+                raise Exception("butler server is already running on %s!" % socket_path)
+            os.unlink(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, _ButlerRequestHandler)
+        os.chmod(socket_path, 0600)
+        self._socket_path = socket_path
+
+    @staticmethod
+    def connect(socket_path):
+        '''
+        return - socket connected to the server, None if no server is listening on socket_path
+        '''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+            return sock
+        except socket.error:
+            sock.close()
+            return None
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if(os.path.exists(self._socket_path)):
+            os.unlink(self._socket_path)
+
+def serve(args):
+    socket_path = args["socket"] if args["socket"] else os.environ.get("BUTLER_SOCKET", ButlerConfig.default_socket())
+    server = ButlerServer(socket_path)
+    sys.stdout = _ThreadOutput(sys.stdout)
+    sys.stderr = _ThreadOutput(sys.stderr)
+    print "butler serves on %s" % socket_path
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
     finally:
-        ps.popd()
+        server.server_close()
 
-def main(argv):
-    # python butler.py
-    #
-    ButlerConfig.load()
+def _forward(socket_path, argv):
+    '''
+    Run the command by butler server if one is listening on socket_path.
+    argv - list of string, the arguments after "butler"
+    return - int, exit status of the command, None if there is no server
+    '''
+    sock = ButlerServer.connect(socket_path)
+    if(sock is None):
+        return None
+    try:
+        _send_message(sock, {"argv": argv, "cwd": os.getcwd()})
+        response = _recv_message(sock)
+        if(response is None):
+            raise Exception("butler server closed the connection without a response!")
+    finally:
+        sock.close()
+    sys.stdout.write(response["output"].encode("utf-8"))
+    sys.stdout.flush()
+    return response["status"]
+
+def _add_global_arguments(parser):
+    '''
+    Add the options given before the command, main() parses them first to find the command.
+    '''
+    parser.add_argument('--socket', action='store',
+                        dest='socket',
+                        default=None,
+                        help='Store the unix socket of butler server, $BUTLER_SOCKET by default')
+    parser.add_argument('--trace', action='store',
+                        dest='trace',
+                        default=None,
+                        help='Store the file to save the chrome trace events of the command')
+    parser.add_argument('--profile', action='store',
+                        dest='profile',
+                        default=None,
+                        help='Store the file to save the cProfile statistics of the command')
+
+def _build_parser():
     parser = argparse.ArgumentParser(prog='butler', 
                                      description="butler to assist CI/CD construction")
+    _add_global_arguments(parser)
     subparsers = parser.add_subparsers(dest = 'command')
     # Add sub-commands: ci|cd
     #
     parsers_ci = subparsers.add_parser('ci', help='commands to support ci setup')
     parsers_cd = subparsers.add_parser('cd', help='commands to support cd setup')
+    parsers_serve = subparsers.add_parser('serve', help='serve the commands of butler clients on a unix socket')
+    parsers_serve.add_argument('--socket', action='store',
+                               dest='socket',
+                               default=None,
+                               help='Store the unix socket to listen on, $BUTLER_SOCKET or ~/.butler/butler.sock by default')
+    parsers_serve.set_defaults(func=serve)
     
     parent_parser_ci = argparse.ArgumentParser(add_help=False)
     parent_parser_ci.add_argument('--prodname', action='store', 
@@ -1195,6 +3374,19 @@ def main(argv):
                                                         parents=[parent_parser_ci])
     parser_prebuild_multi_repo.set_defaults(func=pre_build_multi_repo)
 
+    parser_prebuild_batch = subparsers_ci.add_parser('pre_build_batch',
+                                                     help='Run pre_build_multi_repo for several products at the same time')
+    parser_prebuild_batch.add_argument('--batchfile', action='store',
+                                       dest='batchfile',
+                                       required=True,
+                                       help='Store the json list of products, [{"prodname":..., "prodversion":..., "builddir":..., "buildurl":...}, ...]')
+    parser_prebuild_batch.add_argument('--parallel', action='store',
+                                       dest='parallel',
+                                       type=int,
+                                       default=None,
+                                       help='Store how many products run at the same time, %d by default' % _PRE_BUILD_BATCH_WORKERS)
+    parser_prebuild_batch.set_defaults(func=pre_build_batch)
+
     parser_postbuild_composite_product = subparsers_ci.add_parser('post_build_composite_product',
                                                                 help='Support composite product at post-build stage')
     parser_postbuild_composite_product.add_argument('--builddir',
@@ -1225,6 +3417,15 @@ def main(argv):
                                                    dest='tdir',
                                                    default=None,
                                                    help='Store the product download directory')
+    parser_download_composite_product.add_argument('--parallel', action='store',
+                                                   dest='parallel',
+                                                   type=int,
+                                                   default=None,
+                                                   help='Store the number of parallel downloads')
+    parser_download_composite_product.add_argument('--incremental', action='store_true',
+                                                   dest='incremental',
+                                                   default=False,
+                                                   help='Only download the components changed since the nearest local version')
     parser_download_composite_product.set_defaults(func=download_composite_product)
     
     parser_download_single_product = subparsers_cd.add_parser('download_single_product',
@@ -1241,14 +3442,54 @@ def main(argv):
                                                    dest='tdir',
                                                    default=None,
                                                    help='Store the product download directory')
+    parser_download_single_product.add_argument('--parallel', action='store',
+                                                   dest='parallel',
+                                                   type=int,
+                                                   default=None,
+                                                   help='Store the number of parallel downloads')
     parser_download_single_product.set_defaults(func=download_single_product)
 
-    args = parser.parse_args(argv[1:])
+    return parser
+
+def _run(argv, cwd=None):
+    '''
+    argv - list of string, the arguments after "butler"
+    cwd - string, the directory the relative paths of the arguments are relative to, the current one by default
+    '''
+    args = _build_parser().parse_args(argv)
     dictargs = vars(args)
-    args.func(dictargs)
+    if(cwd):
+        for name in _PATH_ARGS:
+            if(dictargs.get(name)):
+                dictargs[name] = os.path.join(cwd, dictargs[name])
+
+    if(args.command == "serve"):
+        return args.func(dictargs)
+    tracing.traceCommand("%s %s" % (args.command, args.sub_command), args.func, dictargs, args.trace, args.profile,
+                         argv=["butler"] + list(argv))
+
+def main(argv):
+    # python butler.py
+    #
+    # Commands are forwarded to butler server when a socket is given and a server listens on it, otherwise
+    # they run in this process.
+    #
+    global_parser = argparse.ArgumentParser(add_help=False)
+    _add_global_arguments(global_parser)
+    (global_args, rest) = global_parser.parse_known_args(argv[1:])
+    socket_path = global_args.socket if global_args.socket else os.environ.get("BUTLER_SOCKET")
+    command = rest[0] if rest else None
+    if(socket_path and command != "serve"):
+        status = _forward(socket_path, argv[1:])
+        if(status is not None):
+            return status
+
+    ButlerConfig.load()
+    _run(argv[1:])
+    return 0
     
 if __name__ == "__main__":
-    main(sys.argv)
+    sys.exit(main(sys.argv))
     #print _dash_to_underscore("test-repo1-yes")
     #build = _get_repos_buildneeded("http://localhost:8080/jenkins/job/copd-multi/11/changes", forcebuilds="all")
     #for x in build:
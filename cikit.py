@@ -1,6 +1,7 @@
 import sys
 import argparse
 from cikit.cmds import all_commands
+from cikit.ciutils import tracing
 
 def _commander(cmdName):
     def runCMD(args):
@@ -14,6 +15,14 @@ def _main(argv):
     #
     parser = argparse.ArgumentParser(prog='cikit', 
                                      description="cikit to assist CI/CD construction")
+    parser.add_argument('--trace', action='store',
+                        dest='trace',
+                        default=None,
+                        help='Store the file to save the chrome trace events of the command')
+    parser.add_argument('--profile', action='store',
+                        dest='profile',
+                        default=None,
+                        help='Store the file to save the cProfile statistics of the command')
 
     subparsers = parser.add_subparsers(help='commands')
     
@@ -48,16 +57,16 @@ def _main(argv):
                                  dest='savebuildinfo',
                                  default=False,
                                  help='Set savebuildinfo to true to save build info into file')
-    parser_prebuild.set_defaults(func=_commander('prebuild'))
+    parser_prebuild.set_defaults(func=_commander('prebuild'), command='prebuild')
 
     parser_postbuild = subparsers.add_parser('postbuild',
                                             help='Build supported toolkits for post-build stage',
                                             parents=[parent_parser])
-    parser_postbuild.set_defaults(func=_commander('postbuild'))
+    parser_postbuild.set_defaults(func=_commander('postbuild'), command='postbuild')
     
     args = parser.parse_args(argv[1:])
     dictargs = vars(args)
-    args.func(dictargs)
+    tracing.traceCommand(args.command, args.func, dictargs, args.trace, args.profile)
     
     
 if __name__ == "__main__":
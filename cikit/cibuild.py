@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 import os
-import re
+import collections
 from ciutils.cmdutils import CMDExecutor, CMDExecutorError
 from cierrors import CIBasicError
-from ciutils.fileutils import FileManager
+from ciutils.gitutils import GitTagIndex, GitTagService
+from ciutils.buildinfo import saveProperties
 
 class CIBuild:
     BUIDINFO_FILENAME = "build-info.properties"
+    LABEL_PUSH_RETRIES = 5
 
     def __init__(self, workDir, prodVersion, buildName, gitRemote="origin"):
         self._workDir = workDir
@@ -15,26 +17,30 @@ class CIBuild:
         self._gitRemote = gitRemote
         
     def _saveBuildInfo(self, buildInfo):
-        content = ""
         filepath = self._workDir + os.sep + self.BUIDINFO_FILENAME
         try:
-            for key in buildInfo.keys():
-                content = content + key + "=" + buildInfo[key] + "\n"
-
-            content.rstrip("\n")
-            FileManager.saveTextFile(filepath, content)
+            saveProperties(filepath, buildInfo.items())
         except Exception as err:
             raise CIBuildError("Failed on method _saveBuildInfo!", err)
 
     def prebuild(self, saveBuildInfo=False):
         try:
-            nextBN = self.getNextBuildNumber()
             currentCommit = self.getCurrentCommit()
-            buildVersion = self._prodVersion + "_b" + str(nextBN)
-            buildLabel = buildVersion
-            self.createLabel(buildLabel, currentCommit)
+            # Another build publishing the same label first rejects ours, then the label of the
+            # next build number is tried.
+            #
+            for attempt in range(self.LABEL_PUSH_RETRIES + 1):
+                nextBN = self.getNextBuildNumber()
+                buildVersion = self._prodVersion + "_b" + str(nextBN)
+                buildLabel = buildVersion
+                if(self.createLabel(buildLabel, currentCommit)):
+                    break
+                GitTagService(self._workDir, self._gitRemote).fetchTags([self._prodVersion + "_b*"])
+            else:
+                raise CIBuildError("Label %s was rejected %d times!" % (buildLabel, self.LABEL_PUSH_RETRIES + 1))
+
             if(saveBuildInfo):
-                buildInfo = {}
+                buildInfo = collections.OrderedDict()
                 buildInfo['build.name'] = self._buildName
                 buildInfo['build.number'] = str(nextBN);
                 buildInfo['build.version'] = buildVersion
@@ -46,26 +52,19 @@ class CIBuild:
             raise CIBuildError("Failed on method prebuild!", err)
 
     def createLabel(self, label, commit):
+        """
+        :return: bool, False if the remote rejected the label because it exists already
+        """
         try:
-            cmdline = "git tag " + label + " " + commit
-            cmd = CMDExecutor(cmdline, self._workDir)
-            cmd.execute()
-            cmdline = "git push " + self._gitRemote + " " + label
-            cmd = CMDExecutor(cmdline, self._workDir)
-            cmd.execute()
+            return GitTagService(self._workDir, self._gitRemote).pushTags([label], commit)
         except Exception as err:
             raise CIBuildError("Failed on method createLabel", err)
     
     def getNextBuildNumber(self):
         iNextBN = 1
-        cmdline = "git tag -l " + self._prodVersion + "* --sort=-version:refname"
-        cmd = CMDExecutor(cmdline, self._workDir)
         try:
-            output = cmd.execute()
-            if(output):
-                listOutput = output.split("\n")
-                sLatestBN =  re.sub(self._prodVersion+'_b', '', listOutput[0], flags=re.IGNORECASE)
-                latestBN = int(sLatestBN)
+            latestBN = GitTagIndex.forWorkDir(self._workDir).latestNumber(self._prodVersion + "_b", ignoreCase=True)
+            if(latestBN is not None):
                 iNextBN = latestBN + 1
         except Exception as err:
             raise CIBuildError("Failed on method getNextBuildNumber!", err)
@@ -73,8 +72,7 @@ class CIBuild:
         return iNextBN
 
     def getCurrentCommit(self):
-        cmdline = "git rev-parse HEAD"
-        cmd = CMDExecutor(cmdline, self._workDir)
+        cmd = CMDExecutor(["git", "rev-parse", "HEAD"], self._workDir)
         try:
             output = cmd.execute()
             return output.lstrip('\n\s').rstrip('\n\s')
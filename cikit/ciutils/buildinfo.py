@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+import os
+import json
+import collections
+from ..cierrors import CIBasicError
+
+class PropertiesWriter:
+    """
+    Streams "key=value" lines to a temporary file next to filePath, which replaces filePath when the
+    writer is committed. Readers of filePath see either the previous file or the complete new one,
+    never a partial one.
+
+    with PropertiesWriter(filePath) as writer:
+        writer.write(key, value)
+    """
+    def __init__(self, filePath):
+        self._filePath = filePath
+        self._tmpPath = "%s.tmp.%d" % (filePath, os.getpid())
+        self._file = open(self._tmpPath, "w")
+
+    def write(self, key, value):
+        self._file.write("%s=%s\n" % (key, value))
+
+    def writeAll(self, items):
+        """
+        :param items: iterable of (key, value)
+        """
+        self._file.writelines("%s=%s\n" % (k, v) for (k, v) in items)
+
+    def commit(self):
+        self._file.close()
+        os.rename(self._tmpPath, self._filePath)
+
+    def abort(self):
+        self._file.close()
+        if(os.path.exists(self._tmpPath)):
+            os.remove(self._tmpPath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if(excType is None):
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+def saveProperties(filePath, items):
+    """
+    Write the properties atomically.
+    :param items: iterable of (key, value), written in its order
+    """
+    try:
+        with PropertiesWriter(filePath) as writer:
+            writer.writeAll(items)
+    except Exception as err:
+        raise BuildInfoError("Failed on method saveProperties!", err)
+
+def loadProperties(filePath):
+    """
+    Read the "key=value" lines written by PropertiesWriter, blank lines and comments are skipped.
+    :return: collections.OrderedDict, in the order of the file
+    """
+    props = collections.OrderedDict()
+    try:
+        with open(filePath, "r") as f:
+            for line in f:
+                line = line.rstrip("\r\n")
+                if(not line.strip() or line.lstrip()[0] in "#!"):
+                    continue
+                (key, sep, value) = line.partition("=")
+                props[key.strip()] = value.lstrip()
+    except Exception as err:
+        raise BuildInfoError("Failed on method loadProperties!", err)
+    return props
+
+def _str(value):
+    # json loads every string as unicode.
+    #
+    return value.encode("utf-8") if isinstance(value, unicode) else value
+
+def propertyPrefix(repoName):
+    """
+    :return: string, the prefix of the properties of the repository (i.e. "my_repo" of "my-repo")
+    """
+    return repoName.replace("-", "_")
+
+class RepoBuildInfo(object):
+    """
+    Typed build info of one repository, the properties "<prefix>_build_number", "<prefix>_build_needed" ...
+    Fields missing from the properties are None.
+    """
+    # (attribute, property suffix, type)
+    #
+    FIELDS = (("buildNumber", "_build_number", int),
+              ("uBuildNumber", "_u_build_number", int),
+              ("buildVersion", "_build_version", str),
+              ("buildTag", "_build_tag", str),
+              ("uBuildTag", "_u_build_tag", str),
+              ("buildNeeded", "_build_needed", bool),
+              ("commit", "_build_commit", str),
+              ("abbrevCommit", "_build_abbrevcommit", str),
+              ("commitAuthor", "_build_commit_author", str),
+              ("branch", "_build_branch", str),
+              ("currentVersion", "_build_current_version", str))
+
+    __slots__ = ("prefix",) + tuple(f[0] for f in FIELDS)
+
+    # Longer suffixes first, so that "_u_build_number" is found before "_build_number".
+    #
+    _SUFFIXES = sorted(((s, a, t) for (a, s, t) in FIELDS), key=lambda f: -len(f[0]))
+
+    _PROPERTY_SUFFIXES = tuple(f[1] for f in FIELDS)
+
+    # "<prefix>_u_build_number" is also the "_build_number" of the repository "<prefix>_u".
+    #
+    _U_FIELDS = {"uBuildNumber": "buildNumber", "uBuildTag": "buildTag"}
+
+    def __init__(self, prefix, **values):
+        self.prefix = prefix
+        for (attr, suffix, kind) in RepoBuildInfo.FIELDS:
+            setattr(self, attr, values.get(attr))
+
+    @staticmethod
+    def toProperty(value):
+        return None if value is None else str(value)
+
+    @staticmethod
+    def fromProperty(kind, value):
+        if(value is None):
+            return None
+        if(kind is bool):
+            return value == "True"
+        return kind(value)
+
+    @staticmethod
+    def splitKey(key, prefixes=None):
+        """
+        "<prefix>_u_build_number" and "<prefix>_u_build_tag" are split as the unique build number and tag of
+        "<prefix>", unless only "<prefix>_u" is in prefixes.
+        :param prefixes: set of string, the prefixes of the repositories known to be in the build
+        :return: (prefix, attribute), (None, None) if key isn't a repository property
+        """
+        for (suffix, attr, kind) in RepoBuildInfo._SUFFIXES:
+            if(key.endswith(suffix)):
+                prefix = key[:-len(suffix)]
+                if(prefixes is not None and attr in RepoBuildInfo._U_FIELDS and
+                   prefix not in prefixes and prefix + "_u" in prefixes):
+                    return (prefix + "_u", RepoBuildInfo._U_FIELDS[attr])
+                return (prefix, attr)
+        return (None, None)
+
+    def properties(self):
+        """
+        :return: generator of (key, value), the properties of the fields which are not None
+        """
+        prefix = self.prefix
+        return ((prefix + suffix, str(value)) for (suffix, value) in
+                zip(RepoBuildInfo._PROPERTY_SUFFIXES, self.values()) if value is not None)
+
+    def values(self):
+        # In the order of FIELDS.
+        #
+        return [self.buildNumber, self.uBuildNumber, self.buildVersion, self.buildTag, self.uBuildTag, self.buildNeeded,
+                self.commit, self.abbrevCommit, self.commitAuthor, self.branch, self.currentVersion]
+
+class BuildInfo:
+    """
+    build-info.properties of a product build: the product properties ("product_name", "build_type" ...)
+    and the RepoBuildInfo of every repository.
+
+    save() streams build-info.properties and writes build-info.json next to it, both atomically. The
+    json sidecar keeps the fields of each repository as one array, load() reads it instead of parsing
+    the properties and creates the RepoBuildInfo of a repository only when it is looked up. The sidecar
+    records the size, mtime and inode of the properties file it was written with, a properties file
+    changed since then is parsed instead.
+    """
+    PROPERTIES_FILENAME = "build-info.properties"
+    SIDECAR_FORMAT = 1
+
+    def __init__(self, product=None, repos=None):
+        """
+        :param product: dict, the product properties, in the order of the file if it is ordered
+        :param repos: list of RepoBuildInfo
+        """
+        self._product = collections.OrderedDict(product or {})
+        self._records = collections.OrderedDict((r.prefix, r) for r in (repos or []))
+        self._rows = {}
+
+    @staticmethod
+    def fromProperties(props):
+        """
+        :param props: dict, i.e. loaded from build-info.properties
+        """
+        if(isinstance(props, BuildInfo)):
+            return props
+        product = collections.OrderedDict()
+        repos = collections.OrderedDict()
+        kinds = dict((attr, kind) for (attr, suffix, kind) in RepoBuildInfo.FIELDS)
+        splits = [(key, value) + RepoBuildInfo.splitKey(key) for (key, value) in props.items()]
+
+        # Only the "_u_" keys are ambiguous, the prefixes of the others tell which repositories are in the build.
+        #
+        prefixes = set(prefix for (key, value, prefix, attr) in splits if prefix is not None and attr not in RepoBuildInfo._U_FIELDS)
+        for (key, value, prefix, attr) in splits:
+            if(attr in RepoBuildInfo._U_FIELDS):
+                (prefix, attr) = RepoBuildInfo.splitKey(key, prefixes)
+            if(prefix is None or prefix == "product"):
+                product[key] = value
+                continue
+            if(prefix not in repos):
+                repos[prefix] = RepoBuildInfo(prefix)
+            setattr(repos[prefix], attr, RepoBuildInfo.fromProperty(kinds[attr], value))
+        return BuildInfo(product, repos.values())
+
+    @staticmethod
+    def sidecarPath(propertiesPath):
+        return os.path.splitext(propertiesPath)[0] + ".json"
+
+    @staticmethod
+    def load(dirPath, fileName=PROPERTIES_FILENAME):
+        propertiesPath = os.path.join(dirPath, fileName)
+        try:
+            buildInfo = BuildInfo._loadSidecar(propertiesPath)
+            if(buildInfo is None):
+                buildInfo = BuildInfo.fromProperties(loadProperties(propertiesPath))
+            return buildInfo
+        except BuildInfoError:
+            raise
+        except Exception as err:
+            raise BuildInfoError("Failed on method load!", err)
+
+    @staticmethod
+    def _loadSidecar(propertiesPath):
+        """
+        :return: BuildInfo, None if there is no sidecar or it doesn't match the properties file
+        """
+        sidecarPath = BuildInfo.sidecarPath(propertiesPath)
+        if(not os.path.isfile(sidecarPath)):
+            return None
+        with open(sidecarPath, "r") as f:
+            sidecar = json.load(f)
+        if(sidecar.get("format") != BuildInfo.SIDECAR_FORMAT or sidecar.get("stamp") != BuildInfo._stamp(propertiesPath)):
+            return None
+        buildInfo = BuildInfo(collections.OrderedDict((_str(k), _str(v)) for (k, v) in sidecar["product"]))
+        for row in sidecar["repos"]:
+            prefix = _str(row[0])
+            buildInfo._records[prefix] = None
+            buildInfo._rows[prefix] = row
+        return buildInfo
+
+    @staticmethod
+    def _stamp(propertiesPath):
+        st = os.stat(propertiesPath)
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+    def save(self, dirPath, fileName=PROPERTIES_FILENAME):
+        propertiesPath = os.path.join(dirPath, fileName)
+        try:
+            saveProperties(propertiesPath, self.properties())
+            sidecar = {"format": BuildInfo.SIDECAR_FORMAT,
+                       "stamp": BuildInfo._stamp(propertiesPath),
+                       "fields": [attr for (attr, suffix, kind) in RepoBuildInfo.FIELDS],
+                       "product": self._product.items(),
+                       "repos": [[r.prefix] + r.values() for r in self.repos()]}
+            sidecarPath = BuildInfo.sidecarPath(propertiesPath)
+            tmpPath = "%s.tmp.%d" % (sidecarPath, os.getpid())
+            # json.dumps encodes with the C encoder, json.dump streams through the python one.
+            #
+            with open(tmpPath, "w") as f:
+                f.write(json.dumps(sidecar, separators=(",", ":")))
+            os.rename(tmpPath, sidecarPath)
+        except BuildInfoError:
+            raise
+        except Exception as err:
+            raise BuildInfoError("Failed on method save!", err)
+
+    @property
+    def product(self):
+        """
+        :return: collections.OrderedDict, the product properties
+        """
+        return self._product
+
+    def repo(self, repoName):
+        """
+        :param repoName: string, the repository name or its property prefix
+        :return: RepoBuildInfo, raises KeyError if the repository isn't in the build
+        """
+        prefix = propertyPrefix(repoName)
+        record = self._records[prefix]
+        if(record is None):
+            row = self._rows.pop(prefix)
+            record = RepoBuildInfo(prefix, **dict((attr, _str(value)) for ((attr, suffix, kind), value)
+                                                  in zip(RepoBuildInfo.FIELDS, row[1:])))
+            self._records[prefix] = record
+        return record
+
+    def hasRepo(self, repoName):
+        return propertyPrefix(repoName) in self._records
+
+    def repos(self):
+        """
+        :return: generator of RepoBuildInfo, in the order of the file
+        """
+        for prefix in self._records.keys():
+            yield self.repo(prefix)
+
+    def properties(self):
+        """
+        :return: generator of (key, value), the product properties and then the ones of every repository
+        """
+        for item in self._product.items():
+            yield item
+        for record in self.repos():
+            for item in record.properties():
+                yield item
+
+    def items(self):
+        return list(self.properties())
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __getitem__(self, key):
+        """
+        The value of a property as written in build-info.properties, for the callers using it as a dict.
+        """
+        if(key in self._product):
+            return self._product[key]
+        for (suffix, attr, kind) in RepoBuildInfo._SUFFIXES:
+            if(key.endswith(suffix) and key[:-len(suffix)] in self._records):
+                value = getattr(self.repo(key[:-len(suffix)]), attr)
+                if(value is not None):
+                    return RepoBuildInfo.toProperty(value)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+class BuildInfoError(CIBasicError):
+    def __init__(self, errormsg, cause=None):
+        CIBasicError.__init__(self, errormsg, cause)
+
+    def __str__(self):
+        return self.stackError
+
+    def __repr__(self):
+        return self.stackError
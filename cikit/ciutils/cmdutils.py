@@ -1,57 +1,140 @@
 #!/usr/bin/env python
 import sys
 import subprocess
-from pathmanager import PathStackMgr
+import threading
 from ..cierrors import CIBasicError
+from . import tracing
 
 class CMDExecutor:
-    def __init__(self, cmdline, workdir):
+    def __init__(self, cmdline, workdir, timeout=None):
         """
-        :param cmdline: string
-        :param workdir: string
+        :param cmdline: string run by the shell, or list of arguments run without shell
+        :param workdir: string, the command runs in it without changing the current directory of the process
+        :param timeout: int, seconds before the command is killed, None means no timeout
         """
-        assert isinstance(cmdline,(str,unicode)) and len(cmdline) > 0,\
-                "cmdline must be type string and not empty"
+        assert (isinstance(cmdline,(str,unicode)) or isinstance(cmdline,list)) and len(cmdline) > 0,\
+                "cmdline must be type string or list and not empty"
 
         assert isinstance(workdir,(str,unicode)) and len(workdir) > 0,\
                 "workdir must be type string and not empty"
-        
+
         self._cmdline = cmdline
         self._workdir = workdir
-        self._pathStack = PathStackMgr()
-        
+        self._timeout = timeout
+
+    @property
+    def cmdline(self):
+        if(isinstance(self._cmdline, list)):
+            return " ".join(self._cmdline)
+        return self._cmdline
+
     def execute(self):
+        with tracing.span(" ".join(self.cmdline.split()[:2]), "subprocess", argv=self.cmdline, cwd=self._workdir) as span:
+            try:
+                output = self._execute()
+            except CMDExecutorError as err:
+                span.args["exitcode"] = err.errorcode
+                raise
+            span.args["exitcode"] = 0
+            return output
+
+    def _execute(self):
         output=''
+        timedout = []
         try:
-            self._pathStack.pushd(self._workdir)
-            output=subprocess.check_output(self._cmdline, stderr=subprocess.STDOUT, shell=True)
-            self._pathStack.popd()
-        except subprocess.CalledProcessError as cperr:
-            raise CMDExecutorError(self._cmdline, cperr.returncode, cperr.output, cperr)
+            process = subprocess.Popen(self._cmdline, cwd=self._workdir,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       shell=not isinstance(self._cmdline, list))
+            timer = None
+            if(self._timeout):
+                def _kill():
+                    timedout.append(True)
+                    process.kill()
+                timer = threading.Timer(self._timeout, _kill)
+                timer.start()
+            try:
+                output = process.communicate()[0]
+            finally:
+                if(timer):
+                    timer.cancel()
         except Exception as err:
-            raise CMDExecutorError(self._cmdline, 1, "Failed on method execute", err)
-        else:
-            return output
-        
+            raise CMDExecutorError(self.cmdline, 1, "Failed on method execute", err)
+
+        if(timedout):
+            raise CMDExecutorError(self.cmdline, process.returncode,
+                                   "Killed after %s seconds\n%s" % (self._timeout, output))
+        if(process.returncode != 0):
+            raise CMDExecutorError(self.cmdline, process.returncode, output)
+        return output
+
+class CMDPool:
+    """
+    Bounded pool of worker threads running commands. Commands never change the current directory
+    of the process, so any number of them can run at the same time on different directories.
+    """
+    _shared = None
+    _sharedLock = threading.Lock()
+
+    def __init__(self, workers=8):
+        self._workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def shared():
+        with CMDPool._sharedLock:
+            if(CMDPool._shared is None):
+                CMDPool._shared = CMDPool()
+        return CMDPool._shared
+
+    def submit(self, cmdline, workdir, timeout=None):
+        """
+        :return: multiprocessing.pool.AsyncResult, get() returns the output or raises CMDExecutorError
+        """
+        cmd = CMDExecutor(cmdline, workdir, timeout)
+        with self._lock:
+            if(self._pool is None):
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self._workers)
+        return self._pool.apply_async(tracing.bind(cmd.execute))
+
+    def run(self, cmdline, workdir, timeout=None):
+        """
+        Run the command in the calling thread and return its output.
+        """
+        return CMDExecutor(cmdline, workdir, timeout).execute()
+
+    def runAll(self, commands, timeout=None):
+        """
+        :param commands: list of (cmdline, workdir)
+        :return: list of outputs in the same order as commands
+        """
+        futures = [self.submit(cmdline, workdir, timeout) for (cmdline, workdir) in commands]
+        return [f.get(sys.maxint) for f in futures]
+
 class CMDExecutorError(CIBasicError):
     def __init__(self, cmdline, errorcode, errormsg, cause=None):
         CIBasicError.__init__(self, errormsg, cause)
         self._cmdline = cmdline
         self._errorcode = errorcode
-        
+
     def __repr__(self):
         return self.stackError
-    
+
     def __str__(self):
         return self.stackError
-    
+
+    @property
+    def errorcode(self):
+        return self._errorcode
+
     @property
     def error(self):
         value = super(self.__class__,self).error
         value += "\n[CMD]: " + self._cmdline + \
                 "\n[CMD Error Code]: " + str(self._errorcode)
         return value
-    
+
 if __name__ == "__main__":
     try:
         cmd = CMDExecutor("git tag","/Users/mike/Documents/MikeWorkspace/FreessureCoffee/service")
@@ -59,4 +142,4 @@ if __name__ == "__main__":
     except Exception as err:
         print err
     else:
-        print output
\ No newline at end of file
+        print output
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+import os
+import re
+import glob
+import struct
+import threading
+import uuid
+from ..cierrors import CIBasicError
+from .cmdutils import CMDExecutor, CMDExecutorError
+
+class GitTagIndex:
+    """
+    Build numbers of the tags of a git repository, read directly from packed-refs and refs/tags
+    without running git. A tag "<prefix><number>" (i.e. "1.0.0_b12") is indexed as the highest
+    number of its prefix, so the latest build number of any prefix is a dict lookup. refresh()
+    only parses packed-refs again when the file changed, and only loose tags not seen before.
+    """
+    _indexes = {}
+    _indexesLock = threading.Lock()
+    _TAG_PATTERN = re.compile(r"^(.*?)(\d+)$")
+
+    def __init__(self, gitDir):
+        self._gitDir = gitDir
+        self._commonDir = GitTagIndex._findCommonDir(gitDir)
+        self._lock = threading.Lock()
+        self._packedStamp = None
+        self._packedMax = {}
+        self._packedMaxNoCase = {}
+        self._looseTags = set()
+        self._looseMax = {}
+        self._looseMaxNoCase = {}
+
+    @staticmethod
+    def forWorkDir(workDir):
+        """
+        :param workDir: string, work tree of the git repository
+        :return: GitTagIndex, shared by all the callers of the same repository and refreshed
+        """
+        try:
+            gitDir = GitTagIndex.findGitDir(workDir)
+            with GitTagIndex._indexesLock:
+                if(gitDir not in GitTagIndex._indexes):
+                    GitTagIndex._indexes[gitDir] = GitTagIndex(gitDir)
+                index = GitTagIndex._indexes[gitDir]
+            index.refresh()
+            return index
+        except GitTagIndexError:
+            raise
+        except Exception as err:
+            raise GitTagIndexError("Failed on method forWorkDir!", err)
+
+    @staticmethod
+    def findGitDir(workDir):
+        dotGit = os.path.join(workDir, ".git")
+        if(os.path.isdir(dotGit)):
+            return os.path.realpath(dotGit)
+
+        # Work trees and submodules have a ".git" file pointing to the real git directory.
+        #
+        if(os.path.isfile(dotGit)):
+            with open(dotGit, "r") as f:
+                content = f.read().strip()
+            if(content.startswith("gitdir:")):
+                return os.path.realpath(os.path.join(workDir, content[len("gitdir:"):].strip()))
+
+        if(os.path.isdir(os.path.join(workDir, "refs")) and os.path.isfile(os.path.join(workDir, "HEAD"))):
+            return os.path.realpath(workDir)
+
+        raise GitTagIndexError("%s is not a git repository!" % workDir)
+
+    @staticmethod
+    def _findCommonDir(gitDir):
+        commonDirFile = os.path.join(gitDir, "commondir")
+        if(os.path.isfile(commonDirFile)):
+            with open(commonDirFile, "r") as f:
+                return os.path.realpath(os.path.join(gitDir, f.read().strip()))
+        return gitDir
+
+    @staticmethod
+    def _addTag(tag, maxNumbers, maxNumbersNoCase):
+        m = GitTagIndex._TAG_PATTERN.match(tag)
+        if(m):
+            prefix = m.group(1)
+            number = int(m.group(2))
+            if(number > maxNumbers.get(prefix, -1)):
+                maxNumbers[prefix] = number
+            if(number > maxNumbersNoCase.get(prefix.lower(), -1)):
+                maxNumbersNoCase[prefix.lower()] = number
+
+    def _refreshPacked(self):
+        packedRefs = os.path.join(self._commonDir, "packed-refs")
+        try:
+            st = os.stat(packedRefs)
+            stamp = (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            stamp = None
+
+        if(stamp == self._packedStamp):
+            return
+
+        packedMax = {}
+        packedMaxNoCase = {}
+        if(stamp):
+            with open(packedRefs, "r") as f:
+                for line in f:
+                    # Skip the header and the peeled lines of annotated tags.
+                    #
+                    if(line.startswith("#") or line.startswith("^")):
+                        continue
+                    parts = line.split()
+                    if(len(parts) == 2 and parts[1].startswith("refs/tags/")):
+                        GitTagIndex._addTag(parts[1][len("refs/tags/"):], packedMax, packedMaxNoCase)
+
+        self._packedMax = packedMax
+        self._packedMaxNoCase = packedMaxNoCase
+        self._packedStamp = stamp
+
+    def _refreshLoose(self):
+        tagsDir = os.path.join(self._commonDir, "refs", "tags")
+        looseTags = set()
+        for (dirpath, dirnames, filenames) in os.walk(tagsDir):
+            for filename in filenames:
+                tag = os.path.relpath(os.path.join(dirpath, filename), tagsDir).replace(os.sep, "/")
+                looseTags.add(tag)
+
+        # A deleted tag could have been the highest one of its prefix, so start over.
+        #
+        if(not self._looseTags.issubset(looseTags)):
+            self._looseTags = set()
+            self._looseMax = {}
+            self._looseMaxNoCase = {}
+
+        for tag in looseTags - self._looseTags:
+            GitTagIndex._addTag(tag, self._looseMax, self._looseMaxNoCase)
+        self._looseTags = looseTags
+
+    def refresh(self):
+        with self._lock:
+            self._refreshPacked()
+            self._refreshLoose()
+
+    def latestNumber(self, prefix, ignoreCase=False):
+        """
+        :param prefix: string, tag prefix before the number (i.e. "1.0.0_b")
+        :return: int, the highest number of the tags "<prefix><number>", None if there is no such tag
+        """
+        with self._lock:
+            if(ignoreCase):
+                (packedMax, looseMax, key) = (self._packedMaxNoCase, self._looseMaxNoCase, prefix.lower())
+            else:
+                (packedMax, looseMax, key) = (self._packedMax, self._looseMax, prefix)
+            numbers = [n for n in (packedMax.get(key), looseMax.get(key)) if n is not None]
+            return max(numbers) if numbers else None
+
+class GitTagService:
+    """
+    Create the tags of a build and publish them with one "git push --atomic": either all of them
+    are published or none. A rejected push means another build published one of the tags first,
+    the caller then allocates other numbers after fetchTags() and pushes again.
+
+    The tags are annotated with a unique id, so every build pushes its own tag objects. Lightweight
+    tags of two builds of the same commit would be the same refs, and git reports the second push
+    "up-to-date" instead of rejecting it.
+    """
+    _REJECTED = ("[rejected]", "already exists", "atomic push failed")
+
+    # Tagger of the build agents whose identity git can't find or guess.
+    #
+    _TAGGER = ["-c", "user.name=butler", "-c", "user.email=butler@localhost"]
+
+    def __init__(self, workDir, remote="origin"):
+        self._workDir = workDir
+        self._remote = remote
+        self._tagger = None
+
+    def pushTags(self, tags, commit, message=None):
+        """
+        :param tags: list of string, tag names
+        :param commit: string, the commit all the tags point to
+        :param message: string, the message of the tags (i.e. the build url), the tag name by default
+        :return: bool, False if one of the tags exists already, locally or on the remote. The tags created
+                 by the call are deleted then.
+        """
+        message = "%s\n\nbutler-tag-id: %s" % (message if message else " ".join(tags), uuid.uuid4().hex)
+        created = []
+        try:
+            # A tag fetched before is never overwritten, "git tag" fails with "already exists".
+            #
+            for tag in tags:
+                CMDExecutor(["git"] + self._taggerOptions() + ["tag", "-a", "-m", message, tag, commit],
+                            self._workDir).execute()
+                created.append(tag)
+            CMDExecutor(["git", "push", "--atomic", self._remote] + ["refs/tags/%s" % tag for tag in tags], self._workDir).execute()
+            return True
+        except CMDExecutorError as err:
+            if(not any(r in str(err) for r in GitTagService._REJECTED)):
+                self.deleteLocalTags(created)
+                raise GitTagServiceError("Failed on method pushTags!", err)
+        except Exception as err:
+            self.deleteLocalTags(created)
+            raise GitTagServiceError("Failed on method pushTags!", err)
+
+        self.deleteLocalTags(created)
+        return False
+
+    def _taggerOptions(self):
+        if(self._tagger is None):
+            try:
+                CMDExecutor(["git", "var", "GIT_COMMITTER_IDENT"], self._workDir).execute()
+                self._tagger = []
+            except CMDExecutorError:
+                self._tagger = GitTagService._TAGGER
+        return self._tagger
+
+    def deleteLocalTags(self, tags):
+        if(not tags):
+            return
+        try:
+            CMDExecutor(["git", "tag", "-d"] + list(tags), self._workDir).execute()
+        except CMDExecutorError:
+            pass
+
+    def fetchTags(self, patterns):
+        """
+        Fetch the remote tags matching the patterns, so that the tag index knows the numbers other
+        builds published.
+        :param patterns: list of string, i.e. ["1.0.0_b*"]
+        """
+        try:
+            refspecs = ["+refs/tags/%s:refs/tags/%s" % (p, p) for p in patterns]
+            CMDExecutor(["git", "fetch", "--no-tags", self._remote] + refspecs, self._workDir).execute()
+        except Exception as err:
+            raise GitTagServiceError("Failed on method fetchTags!", err)
+
+# Minimum abbreviation length of git, kept for repositories of less than 2^14 objects.
+#
+ABBREV_LENGTH = 7
+
+def approximateObjectCount(workDir):
+    """
+    The object count git bases the abbreviation length on: the objects of the packs of the repository
+    and of its alternates (i.e. .repo/project-objects), read from the headers of the pack indexes.
+    :return: int
+    """
+    try:
+        objectsDir = os.path.join(GitTagIndex._findCommonDir(GitTagIndex.findGitDir(workDir)), "objects")
+        objectsDirs = [objectsDir]
+        alternates = os.path.join(objectsDir, "info", "alternates")
+        if(os.path.isfile(alternates)):
+            with open(alternates, "r") as f:
+                objectsDirs.extend(os.path.join(objectsDir, line.strip()) for line in f
+                                   if line.strip() and not line.startswith("#"))
+
+        count = 0
+        for d in objectsDirs:
+            for idx in glob.glob(os.path.join(d, "pack", "*.idx")):
+                if(not os.path.isfile(idx[:-len(".idx")] + ".pack")):
+                    continue
+                with open(idx, "rb") as f:
+                    header = f.read(8 + 256 * 4)
+                # Version 2 indexes start with "\377tOc" and the version, version 1 with the fanout
+                # table. Its last entry is the number of objects.
+                #
+                offset = 8 if header.startswith("\377tOc") else 0
+                count += struct.unpack("!I", header[offset + 255 * 4:offset + 256 * 4])[0]
+        return count
+    except GitTagIndexError:
+        raise
+    except Exception as err:
+        raise GitTagIndexError("Failed on method approximateObjectCount!", err)
+
+def abbrevLength(workDir):
+    """
+    The length git abbreviates commits to with core.abbrev "auto" before lengthening ambiguous ones:
+    half the bits of the object count rounded up, in hex digits, at least ABBREV_LENGTH.
+    :return: int
+    """
+    count = approximateObjectCount(workDir)
+    return max(ABBREV_LENGTH, (count.bit_length() + 1) // 2)
+
+class GitTagServiceError(CIBasicError):
+    def __init__(self, errormsg, cause=None):
+        CIBasicError.__init__(self, errormsg, cause)
+
+    def __str__(self):
+        return self.stackError
+
+    def __repr__(self):
+        return self.stackError
+
+class GitTagIndexError(CIBasicError):
+    def __init__(self, errormsg, cause=None):
+        CIBasicError.__init__(self, errormsg, cause)
+
+    def __str__(self):
+        return self.stackError
+
+    def __repr__(self):
+        return self.stackError
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import threading
+from ..cierrors import CIBasicError
+
+class Tracer:
+    """
+    Records spans (phases, subprocesses, http requests ...) of the running command as Chrome trace
+    events, the saved file is opened by chrome://tracing or https://ui.perfetto.dev. Spans are only
+    recorded while a tracer is started, otherwise span() costs one attribute lookup.
+
+    The started tracer belongs to the thread which started it, so the commands run at the same time
+    by butler server are traced apart. Worker threads record to it when their tasks are wrapped by
+    bind().
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+        self._threadNames = {}
+        self._pid = os.getpid()
+
+    @staticmethod
+    def current():
+        """
+        :return: Tracer, the tracer of the calling thread, None if tracing is disabled
+        """
+        return getattr(Tracer._local, "tracer", None)
+
+    @staticmethod
+    def start():
+        Tracer._local.tracer = Tracer()
+        return Tracer._local.tracer
+
+    @staticmethod
+    def stop(traceFile):
+        """
+        Stop tracing and save the recorded spans to traceFile.
+        """
+        tracer = Tracer.current()
+        Tracer._local.tracer = None
+        if(tracer):
+            tracer.save(traceFile)
+
+    def addSpan(self, name, category, start, duration, args=None):
+        """
+        :param start: float, seconds since epoch
+        :param duration: float, seconds
+        :param args: dict, shown with the span
+        """
+        thread = threading.current_thread()
+        event = {"name": name,
+                 "cat": category,
+                 "ph": "X",
+                 "ts": int(start * 1000000),
+                 "dur": int(duration * 1000000),
+                 "pid": self._pid,
+                 "tid": thread.ident,
+                 "args": args or {}}
+        with self._lock:
+            self._events.append(event)
+            self._threadNames[thread.ident] = thread.name
+
+    def save(self, traceFile):
+        try:
+            with self._lock:
+                events = [{"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": name}}
+                          for (tid, name) in self._threadNames.items()]
+                events.extend(self._events)
+            with open(traceFile, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        except Exception as err:
+            raise TracingError("Failed on method save!", err)
+
+class Span:
+    """
+    Context manager recording a span from enter to exit. Values known only at the end (exit code,
+    bytes ...) are added to args before exit.
+    """
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        tracer = Tracer.current()
+        if(tracer):
+            if(excType is not None):
+                self.args["error"] = "%s: %s" % (excType.__name__, excValue)
+            tracer.addSpan(self.name, self.category, self._start, time.time() - self._start, self.args)
+        return False
+
+def span(name, category="phase", **args):
+    """
+    :return: Span, to be used as "with span(...) as s:"
+    """
+    return Span(name, category, args)
+
+def addSpan(name, category, start, duration, **args):
+    """
+    Record a span measured by the caller, nothing happens if tracing is disabled.
+    """
+    tracer = Tracer.current()
+    if(tracer):
+        tracer.addSpan(name, category, start, duration, args)
+
+def bind(func):
+    """
+    :return: callable, func running with the tracer of the calling thread, to be submitted to worker threads
+    """
+    tracer = Tracer.current()
+    if(tracer is None):
+        return func
+
+    def _traced(*args, **kwargs):
+        previous = Tracer.current()
+        Tracer._local.tracer = tracer
+        try:
+            return func(*args, **kwargs)
+        finally:
+            Tracer._local.tracer = previous
+    return _traced
+
+def traceCommand(name, func, args, traceFile=None, profileFile=None, argv=None):
+    """
+    Run func(args) as the span of the command, saving the trace to traceFile and the cProfile
+    statistics to profileFile when they are given. cProfile only profiles the calling thread, the
+    tasks of worker threads show as the time waiting for them.
+    :param argv: list of string, the command line recorded with the span, sys.argv by default
+    """
+    if(traceFile):
+        Tracer.start()
+    profiler = None
+    if(profileFile):
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with span(name, "command", argv=" ".join(sys.argv if argv is None else argv)):
+            return func(args)
+    finally:
+        if(profiler):
+            profiler.disable()
+            profiler.dump_stats(profileFile)
+        if(traceFile):
+            Tracer.stop(traceFile)
+
+class TracingError(CIBasicError):
+    def __init__(self, errormsg, cause=None):
+        CIBasicError.__init__(self, errormsg, cause)
+
+    def __str__(self):
+        return self.stackError
+
+    def __repr__(self):
+        return self.stackError
@@ -1,25 +1,48 @@
 #!/usr/bin/env python
 import os
+import re
 
-all_commands={}
-
-my_dir = os.path.dirname(__file__)
-for py in os.listdir(my_dir):
-  if py == '__init__.py' or py == 'command.py':
-    continue
-
-  if py.endswith('.py'):
-    name = py[:-3]
-    mod = __import__(__name__,
-                     globals(),
-                     locals(),
-                     ['%s' % name])
-    mod = getattr(mod, name)
-    try:
-        cmdn = getattr(mod, 'cmdName')
-        clsn = getattr(mod, 'className')
-        cmd = getattr(mod, clsn)()
-        all_commands[cmdn] = cmd
-    except AttributeError:
-      raise SyntaxError('%s/%s does not define class %s' % (
-                         __name__, py, clsn))
\ No newline at end of file
+class CommandRegistry:
+    """
+    The commands of the modules of this package. cmdName and className are read from the sources
+    without importing them, a module is only imported, and its command created, the first time the
+    command is looked up, so starting cikit doesn't pay for the modules of the other commands.
+    """
+    _NAME_PATTERN = re.compile(r"^(cmdName|className)\s*=\s*['\"](\w+)['\"]", re.MULTILINE)
+
+    def __init__(self, cmdDir, package):
+        self._package = package
+        self._modules = {}
+        self._commands = {}
+        for py in sorted(os.listdir(cmdDir)):
+            if(py in ('__init__.py', 'command.py') or not py.endswith('.py')):
+                continue
+            with open(os.path.join(cmdDir, py), 'r') as f:
+                names = dict(CommandRegistry._NAME_PATTERN.findall(f.read()))
+            if('cmdName' not in names or 'className' not in names):
+                raise SyntaxError('%s/%s does not define cmdName and className' % (package, py))
+            self._modules[names['cmdName']] = (py[:-3], names['className'])
+
+    def __contains__(self, cmdName):
+        return cmdName in self._modules
+
+    def __iter__(self):
+        return iter(self._modules)
+
+    def __len__(self):
+        return len(self._modules)
+
+    def keys(self):
+        return self._modules.keys()
+
+    def __getitem__(self, cmdName):
+        if(cmdName not in self._commands):
+            (name, clsn) = self._modules[cmdName]
+            mod = getattr(__import__(self._package, globals(), locals(), [name]), name)
+            try:
+                self._commands[cmdName] = getattr(mod, clsn)()
+            except AttributeError:
+                raise SyntaxError('%s/%s.py does not define class %s' % (self._package, name, clsn))
+        return self._commands[cmdName]
+
+all_commands = CommandRegistry(os.path.dirname(__file__), __name__)
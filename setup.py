@@ -5,5 +5,5 @@ setup(
     version='1.0',
     description='CI Tools',
     author='Mike Zhang',
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
 )
\ No newline at end of file